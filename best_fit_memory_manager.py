@@ -0,0 +1,211 @@
+"""Implementation of malloc and free with a best fit policy.
+
+Like memory_manager.py, except that malloc reserves space from the smallest
+free span that is large enough for the request (best fit) instead of the
+first one (first fit), and neither malloc nor free scans the free list.
+
+We index the free spans in 2 sorted lists:
+* `by_size` holds a (size, start) pair for each free span, so the best fit
+  for a request of size `size` is the first pair that is >= (size, 0),
+  which we find with a binary search (bisect). Ties go to the lowest address.
+* `starts` holds the start address of each free span and `start_to_end`
+  maps a start address to the end of its span, so the neighbors of a range
+  that we free are next to its insertion point in `starts`.
+
+When we call malloc, we remove the best fit from `by_size`. If it is larger
+than the request, then we split it as in memory_manager.py and put the rest
+back into `by_size`. The rest of the span keeps the position of the span in
+`starts`, because it still lies between the same neighbors.
+
+When we call free, we find the insertion point of the range in `starts`
+with a binary search. The free span before it is coalesced with the range
+if it ends at the start of the range and the free span after it if it
+starts at the end of the range.
+
+Notes:
+* The binary searches take O(log n) time, but inserting into and removing
+  from a Python list shifts the elements after the position, which takes
+  O(n) time. The shift is a memmove of pointers, so it is very fast for
+  the sizes here. A balanced search tree (or a skip list) would make every
+  operation O(log n).
+* Best fit leaves the large spans intact for large requests, but it tends to
+  leave small slivers of free space behind. Run the script to compare the
+  fragmentation of best fit and first fit on a random trace, where the
+  fragmentation is 1 - (largest free span) / (total free space).
+
+Run tests:
+
+pytest best_fit_memory_manager.py
+
+Compare with first fit:
+
+python best_fit_memory_manager.py
+
+See also:
+* memory_manager.py
+* segregated_memory_manager.py
+* ostep_free_space_management.md
+
+Sources:
+* https://pages.cs.wisc.edu/~remzi/OSTEP/vm-freespace.pdf
+* https://docs.python.org/3/library/bisect.html
+"""
+import bisect
+import random
+
+class BestFitMemoryManager:
+
+	def __init__(self, capacity):
+		self.by_size = []
+		self.starts = []
+		self.start_to_end = {}
+		self.start_to_size = {}
+		if capacity > 0:
+			self._insert(0, capacity)
+
+	def _insert(self, start, end):
+		bisect.insort(self.by_size, (end - start, start))
+		bisect.insort(self.starts, start)
+		self.start_to_end[start] = end
+
+	def _remove(self, start):
+		end = self.start_to_end.pop(start)
+		del self.by_size[bisect.bisect_left(self.by_size, (end - start, start))]
+		del self.starts[bisect.bisect_left(self.starts, start)]
+
+	def malloc(self, size):
+		assert size > 0
+		i = bisect.bisect_left(self.by_size, (size, 0))
+
+		# Insufficient space.
+		if i == len(self.by_size):
+			return -1
+
+		span_size, start = self.by_size.pop(i)
+		end = self.start_to_end.pop(start)
+		j = bisect.bisect_left(self.starts, start)
+		if span_size == size:
+			del self.starts[j]
+		else:
+			self.starts[j] = start + size
+			self.start_to_end[start + size] = end
+			bisect.insort(self.by_size, (span_size - size, start + size))
+
+		self.start_to_size[start] = size
+
+		return start
+
+	def free(self, start):
+		if start not in self.start_to_size:
+			return False
+
+		end = start + self.start_to_size.pop(start)
+
+		j = bisect.bisect_left(self.starts, start)
+		# Coalesce with the free span after the range.
+		if j < len(self.starts) and self.starts[j] == end:
+			end = self.start_to_end[end]
+			self._remove(self.starts[j])
+		# Coalesce with the free span before the range.
+		if j > 0 and self.start_to_end[self.starts[j - 1]] == start:
+			start = self.starts[j - 1]
+			self._remove(start)
+
+		self._insert(start, end)
+
+		return True
+
+	@property
+	def free_list(self):
+		# for testing.
+		return [[start, self.start_to_end[start]] for start in self.starts]
+
+
+def _fragmentation(memory_manager):
+	sizes = [end - start for start, end in memory_manager.free_list]
+	if not sizes:
+		return 0.0
+	return 1 - max(sizes) / sum(sizes)
+
+
+def _compare_with_first_fit(capacity=1 << 20, num_ops=50000, seed=0):
+	from memory_manager import MemoryManager
+
+	for memory_manager in [MemoryManager(capacity), BestFitMemoryManager(capacity)]:
+		rng = random.Random(seed)
+		starts = []
+		num_failures = 0
+		fragmentation = 0.0
+		for _ in range(num_ops):
+			if (not starts) or (rng.random() < 0.6):
+				# Mostly small requests with a few large ones.
+				size = rng.randint(1, 64) if rng.random() < 0.9 else rng.randint(1024, 16384)
+				start = memory_manager.malloc(size)
+				if start == -1:
+					num_failures += 1
+				else:
+					starts.append(start)
+			else:
+				i = rng.randint(0, len(starts) - 1)
+				starts[i], starts[-1] = starts[-1], starts[i]
+				memory_manager.free(starts.pop())
+			fragmentation += _fragmentation(memory_manager)
+		print(f"{type(memory_manager).__name__}: "
+			f"failed mallocs {num_failures}, "
+			f"free spans {len(memory_manager.free_list)}, "
+			f"mean fragmentation {fragmentation / num_ops:.3f}")
+
+########
+# Tests
+########
+
+
+import pytest
+
+# The tests of memory_manager.py run against the `memory_manager` fixture
+# below.
+from memory_manager import (
+	test_init,
+	test_malloc_ok,
+	test_malloc_fail,
+	test_free_ok,
+	test_free_fail,
+	test_multiple_malloc,
+	test_fragmentation,
+	test_coalesce,
+	test_fuzz,
+)
+
+
+@pytest.fixture
+def memory_manager():
+	return BestFitMemoryManager(1000)
+
+
+def test_best_fit(memory_manager):
+	# Reserve [0, 100), [100, 400), [400, 450) and [450, 500)
+	starts = [memory_manager.malloc(size) for size in [100, 300, 50, 50]]
+	# Free [0, 100) and [400, 450)
+	assert memory_manager.free(starts[0])
+	assert memory_manager.free(starts[2])
+	assert memory_manager.free_list == [[0, 100], [400, 450], [500, 1000]]
+	# First fit would reserve [0, 40).
+	assert memory_manager.malloc(40) == 400
+	assert memory_manager.free_list == [[0, 100], [440, 450], [500, 1000]]
+	# Ties go to the lowest address.
+	assert memory_manager.malloc(500) == 500
+	assert memory_manager.free_list == [[0, 100], [440, 450]]
+
+
+def test_coalesce_both_sides(memory_manager):
+	starts = [memory_manager.malloc(size) for size in [100, 300, 600]]
+	assert memory_manager.free(starts[0])
+	assert memory_manager.free(starts[2])
+	assert memory_manager.free_list == [[0, 100], [400, 1000]]
+	assert memory_manager.free(starts[1])
+	assert memory_manager.free_list == [[0, 1000]]
+	assert memory_manager.by_size == [(1000, 0)]
+
+
+if __name__ == "__main__":
+	_compare_with_first_fit()
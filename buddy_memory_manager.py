@@ -47,6 +47,8 @@ pytest buddy_memory_manager.py
 See also:
 * linked_list_memory_manager.py
 * memory_manager.py
+* free_list_buddy_memory_manager.py
+* slab_memory_manager.py
 * ostep_free_space_management.md
 
 Sources:
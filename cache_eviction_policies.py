@@ -0,0 +1,398 @@
+"""
+Scan-resistant cache eviction policies: 2Q, ARC and W-TinyLFU.
+
+Problem:
+* An LRU cache (lru_cache.py) keeps the most recently used keys, so a single large sequential
+  scan of keys that are used once replaces every key in the cache, including the hot ones.
+* Each policy below has the same interface as LRUCache (get returns -1 on a miss) and is
+  built on the same dict + doubly linked list (lru_cache.OrderedDict), where the front of a
+  list is the least recently used (or oldest) key.
+
+Notes:
+* 2Q (Johnson and Shasha):
+  * A new key goes into A1in, a FIFO queue of about 25% of the capacity. A hit in A1in
+    doesn't move the key, so a key that is used a few times in a short burst looks the same
+    as a key that is used once.
+  * A key that is evicted from A1in is remembered in A1out, a FIFO queue of keys without
+    values ("ghost" entries) of about 50% of the capacity.
+  * A key that is put again while it is in A1out has been used at least twice over a longer
+    period, so it goes into Am, the LRU list for hot keys.
+  * A scan only goes through A1in and A1out, so it doesn't evict the keys in Am.
+* ARC (Megiddo and Modha):
+  * T1 holds keys that have been used once recently and T2 holds keys that have been used at
+    least twice recently. B1 and B2 are the ghost lists of keys that were evicted from T1 and
+    T2. The cache holds the keys in T1 and T2.
+  * The target size p of T1 adapts to the workload: a miss on a key in B1 means that T1 was
+    too small, so we increase p, and a miss on a key in B2 means that T2 was too small, so we
+    decrease p. We evict from T1 if it is larger than p and otherwise from T2.
+  * There is no parameter to tune, and a scan only grows T1 (and B1) as long as the hits in
+    B2 keep p small.
+* W-TinyLFU (Einziger, Friedman and Manes, used by Caffeine):
+  * A new key goes into a small window LRU of about 1% of the capacity. The rest of the
+    capacity is a segmented LRU (SLRU): a key that leaves the window goes into the probation
+    segment and a hit in the probation segment promotes the key to the protected segment
+    (about 80% of the main cache). A key that is demoted from the protected segment goes
+    back to the probation segment.
+  * When the main cache is full, the key that leaves the window (the candidate) is only
+    admitted if it has been used more often than the least recently used key of the probation
+    segment (the victim). Otherwise, we drop the candidate. A scan key is used once, so it is
+    never admitted.
+  * The frequencies are estimated with a count-min sketch (FrequencySketch) of 4-bit
+    counters that covers keys that are no longer in the cache. After every sample_size
+    increments, we halve every counter, so that the frequencies decay over time and keys
+    that used to be hot eventually leave the cache.
+  * Every access increments the sketch once. A get that misses counts as the access, so
+    the put of the same key that follows it in a read-through cache doesn't count again
+    (otherwise every new key would start with a frequency of 2).
+* replay_trace replays a trace of keys against a cache: a get that misses is followed by a
+  put of the key, as in a read-through cache. The hit ratio is the fraction of gets that hit.
+
+Run tests:
+
+pytest cache_eviction_policies.py
+
+Usage:
+python cache_eviction_policies.py trace.txt capacity
+
+where trace.txt has one key per line. It prints the hit ratio of each policy.
+
+Sources:
+* https://www.vldb.org/conf/1994/P439.PDF (2Q)
+* https://www.usenix.org/legacy/events/fast03/tech/full_papers/megiddo/megiddo.pdf (ARC)
+* https://arxiv.org/abs/1512.00727 (TinyLFU)
+* https://github.com/ben-manes/caffeine/wiki/Efficiency
+"""
+import sys
+
+from lru_cache import LRUCache, OrderedDict
+
+class TwoQueueCache:
+
+    def __init__(self, capacity: int, in_fraction: float = 0.25, out_fraction: float = 0.5):
+        assert capacity >= 1
+        self.capacity = capacity
+        self.max_in = max(1, int(capacity * in_fraction))
+        self.max_out = max(1, int(capacity * out_fraction))
+        self.a1_in = OrderedDict()
+        # Ghost entries: the keys are in the order in which they were evicted.
+        self.a1_out = OrderedDict()
+        self.am = OrderedDict()
+
+    def __len__(self):
+        return len(self.a1_in) + len(self.am)
+
+    def get(self, key: int) -> int:
+        if key in self.am:
+            self.am.move_to_end(key)
+            return self.am[key]
+        if key in self.a1_in:
+            return self.a1_in[key]
+        return -1
+
+    def _reclaim(self):
+        if len(self) < self.capacity:
+            return
+        if len(self.a1_in) > self.max_in or len(self.am) == 0:
+            key, _ = self.a1_in.popitem(last=False)
+            self.a1_out[key] = None
+            if len(self.a1_out) > self.max_out:
+                self.a1_out.popitem(last=False)
+        else:
+            self.am.popitem(last=False)
+
+    def put(self, key: int, value: int) -> None:
+        if key in self.am:
+            self.am[key] = value
+            self.am.move_to_end(key)
+        elif key in self.a1_in:
+            self.a1_in[key] = value
+        elif key in self.a1_out:
+            del self.a1_out[key]
+            self._reclaim()
+            self.am[key] = value
+        else:
+            self._reclaim()
+            self.a1_in[key] = value
+
+
+class ARCCache:
+
+    def __init__(self, capacity: int):
+        assert capacity >= 1
+        self.capacity = capacity
+        # Target size of t1
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def get(self, key: int) -> int:
+        if key in self.t1:
+            value = self.t1[key]
+            del self.t1[key]
+            self.t2[key] = value
+            return value
+        if key in self.t2:
+            self.t2.move_to_end(key)
+            return self.t2[key]
+        return -1
+
+    def _replace(self, key):
+        # Evicts a key from t1 or t2 into its ghost list
+        if len(self.t1) > 0 and (
+                len(self.t1) > self.p or
+                (key in self.b2 and len(self.t1) == self.p) or
+                len(self.t2) == 0):
+            evicted_key, _ = self.t1.popitem(last=False)
+            self.b1[evicted_key] = None
+        else:
+            evicted_key, _ = self.t2.popitem(last=False)
+            self.b2[evicted_key] = None
+
+    def put(self, key: int, value: int) -> None:
+        if key in self.t1 or key in self.t2:
+            # A put counts as a use, like a get
+            self.get(key)
+            self.t2[key] = value
+            return
+
+        # Ghost entries only exist after an eviction, so the cache is full here.
+        if key in self.b1:
+            self.p = min(self.capacity, self.p + max(len(self.b2) // len(self.b1), 1))
+            self._replace(key)
+            del self.b1[key]
+            self.t2[key] = value
+            return
+        if key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            self._replace(key)
+            del self.b2[key]
+            self.t2[key] = value
+            return
+
+        l1 = len(self.t1) + len(self.b1)
+        total = l1 + len(self.t2) + len(self.b2)
+        if l1 == self.capacity:
+            if len(self.t1) < self.capacity:
+                self.b1.popitem(last=False)
+                if len(self) == self.capacity:
+                    self._replace(key)
+            else:
+                # b1 is empty and t1 fills the cache
+                self.t1.popitem(last=False)
+        elif total >= self.capacity:
+            if total == 2 * self.capacity:
+                self.b2.popitem(last=False)
+            if len(self) == self.capacity:
+                self._replace(key)
+        self.t1[key] = value
+
+
+class FrequencySketch:
+    """Count-min sketch of 4-bit counters with periodic aging."""
+
+    MAX_COUNT = 15
+
+    def __init__(self, capacity: int, depth: int = 4):
+        # A power of 2, so that we can take a hash modulo the width with a mask
+        self.width = 1 << max(capacity - 1, 1).bit_length()
+        self.depth = depth
+        self.table = [[0] * self.width for _ in range(depth)]
+        self.sample_size = 10 * self.width
+        self.num_increments = 0
+
+    def _indices(self, key):
+        h = hash(key)
+        # Double hashing: the i-th row uses h1 + i * h2
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) ^ (h1 * 0x9e3779b1)) | 1
+        mask = self.width - 1
+        return [(h1 + i * h2) & mask for i in range(self.depth)]
+
+    def frequency(self, key):
+        return min(row[i] for row, i in zip(self.table, self._indices(key)))
+
+    def increment(self, key):
+        for row, i in zip(self.table, self._indices(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+        self.num_increments += 1
+        if self.num_increments == self.sample_size:
+            self._reset()
+
+    def _reset(self):
+        for row in self.table:
+            for i in range(self.width):
+                row[i] >>= 1
+        self.num_increments //= 2
+
+
+class WTinyLFUCache:
+
+    def __init__(self, capacity: int, window_fraction: float = 0.01,
+                 protected_fraction: float = 0.8):
+        assert capacity >= 1
+        self.capacity = capacity
+        self.max_window = max(1, int(capacity * window_fraction))
+        self.max_main = capacity - self.max_window
+        self.max_protected = int(self.max_main * protected_fraction)
+        self.sketch = FrequencySketch(capacity)
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        # The key of the last get that missed, whose access was already counted
+        self.missed_key = None
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def _access(self, key):
+        # Records a use of a key in the cache and returns its value
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            return self.window[key]
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        value = self.probation[key]
+        del self.probation[key]
+        self.protected[key] = value
+        if len(self.protected) > self.max_protected:
+            demoted_key, demoted_value = self.protected.popitem(last=False)
+            self.probation[demoted_key] = demoted_value
+        return value
+
+    def get(self, key: int) -> int:
+        if key not in self.window and key not in self.probation and key not in self.protected:
+            self.sketch.increment(key)
+            self.missed_key = key
+            return -1
+        self.missed_key = None
+        return self._access(key)
+
+    def put(self, key: int, value: int) -> None:
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                segment[key] = value
+                self.missed_key = None
+                self._access(key)
+                return
+
+        if key != self.missed_key:
+            self.sketch.increment(key)
+        self.missed_key = None
+        self.window[key] = value
+        if len(self.window) <= self.max_window:
+            return
+        candidate_key, candidate_value = self.window.popitem(last=False)
+        if len(self.probation) + len(self.protected) < self.max_main:
+            self.probation[candidate_key] = candidate_value
+            return
+        if self.max_main == 0:
+            return
+        victims = self.probation if len(self.probation) > 0 else self.protected
+        victim_key = next(iter(victims))
+        if self.sketch.frequency(candidate_key) > self.sketch.frequency(victim_key):
+            del victims[victim_key]
+            self.probation[candidate_key] = candidate_value
+
+
+POLICIES = {
+    "lru": LRUCache,
+    "2q": TwoQueueCache,
+    "arc": ARCCache,
+    "w-tinylfu": WTinyLFUCache,
+}
+
+def replay_trace(cache, keys):
+    """Returns the hit ratio of a read-through cache on a trace of keys."""
+    num_hits = 0
+    num_gets = 0
+    for key in keys:
+        num_gets += 1
+        if cache.get(key) == -1:
+            cache.put(key, key)
+        else:
+            num_hits += 1
+    return num_hits / num_gets if num_gets > 0 else 0.0
+
+def main():
+    assert len(sys.argv) == 3
+    trace_file = sys.argv[1]
+    capacity = int(sys.argv[2])
+    with open(trace_file) as fin:
+        keys = [line.strip() for line in fin if line.strip()]
+    for name, policy in POLICIES.items():
+        hit_ratio = replay_trace(policy(capacity), keys)
+        print(f"{name}: {hit_ratio:.4f}")
+
+########
+# Tests
+########
+
+
+import pytest
+import random
+
+SCAN_RESISTANT_POLICIES = [TwoQueueCache, ARCCache, WTinyLFUCache]
+
+
+@pytest.mark.parametrize("policy", SCAN_RESISTANT_POLICIES)
+def test_capacity(policy):
+    random.seed(0)
+    capacity = 50
+    cache = policy(capacity)
+    values = {}
+    for _ in range(20000):
+        key = int(random.paretovariate(1)) % 500
+        if random.random() < 0.5:
+            value = cache.get(key)
+            # A hit returns the last value that was put.
+            assert value == -1 or value == values[key]
+        else:
+            values[key] = random.randint(0, 1000)
+            cache.put(key, values[key])
+        assert len(cache) <= capacity
+    assert len(cache) == capacity
+
+
+@pytest.mark.parametrize("policy", [LRUCache] + SCAN_RESISTANT_POLICIES)
+def test_scan(policy):
+    # The hot keys are used over and over between keys that are used once.
+    hot_keys = list(range(20))
+    trace = []
+    for i in range(50):
+        trace += hot_keys + list(range(1000 + 10 * i, 1000 + 10 * (i + 1)))
+    cache = policy(100)
+    replay_trace(cache, trace)
+    # A scan of keys that are used once.
+    replay_trace(cache, range(100000, 101000))
+    num_hot_hits = sum(cache.get(key) != -1 for key in hot_keys)
+    if policy is LRUCache:
+        assert num_hot_hits == 0
+    else:
+        assert num_hot_hits == len(hot_keys)
+
+
+def test_w_tinylfu_frequency():
+    cache = WTinyLFUCache(100)
+    # A read-through miss is a single access.
+    assert cache.get(1) == -1
+    cache.put(1, 1)
+    assert cache.sketch.frequency(1) == 1
+    assert cache.get(1) == 1
+    assert cache.sketch.frequency(1) == 2
+    # So is a put without a get and an update.
+    cache.put(2, 2)
+    assert cache.sketch.frequency(2) == 1
+    cache.put(2, 3)
+    assert cache.sketch.frequency(2) == 2
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,84 @@ http://web.archive.org/web/20230202171450/https://www.geeksforgeeks.org/external
 python external_merge_sort.py
 sort input.txt > expected.txt
 cmp expected.txt output.txt
-rm expected.txt input.txt output.txt partition*.txt
+rm expected.txt input.txt output.txt
 ```
 
+If `partition_size` and `num_partitions` are passed to `external_sort`, then
+the input is split into `num_partitions` runs of `partition_size` lines and all
+the runs are merged at once. Otherwise, `external_sort` runs in a
+memory-budgeted mode:
+
+* Runs are sized to fit in `memory_budget` bytes (by default a fraction of
+  the available RAM according to `psutil`). We estimate the memory of a
+  run as the length of each line plus the overhead of an empty str and a
+  list slot.
+* Runs are merged in multiple passes with at most `max_fan_in` runs open at
+  once, so we never run out of file descriptors. Each pass reduces the number
+  of runs by a factor of `max_fan_in`.
+* Reads and writes go through large buffers (`readlines` with a size hint,
+  `writelines`, and iterating over the files in `heapq.merge`) instead of
+  a `readline` and a `write` call per line.
+* The runs are written to a temporary directory under `tmp_dir`, which is
+  removed at the end.
+* With `run_generator="replacement_selection"`, the runs are formed with a
+  heap of lines that fills the budget. We pop the smallest line, write it to
+  the current run and push the next input line. If the next line is smaller
+  than the line we just wrote, it can't go in the current run, so we hold it
+  back in a list for the next run instead (rather than pushing
+  (run number, line) tuples, which would double the memory per line). When
+  the heap is empty, the list becomes the heap of the next run. On random
+  input the runs are about twice the size of the memory, and sorted input
+  yields a single run.
+* `key` sorts by `key(line)` (the line without its newline) and `field`,
+  `separator` and `numeric` sort by a field like
+  `sort -k field,field -t separator [-n]` (fields are 1-indexed, a missing
+  field is empty and the key of a numeric field is its leading number or 0
+  if it doesn't start with a number, like in `sort -n`).
+  Ties are broken by the whole line. The key of a line is computed once,
+  during run generation, and the runs store pickled (key, line) records,
+  so that the merge compares the stored keys instead of parsing the lines
+  again.
+* `reverse` sorts in descending order. The runs are sorted in descending
+  order too and `heapq.merge` merges them with `reverse=True`.
+* With `async_io=True`, the merge overlaps the disk reads, the heap work and
+  the writes. Every run has one block of lines being merged and the next
+  block being read on a background thread (double buffering), and a full
+  output block is written on a background thread while the next one is
+  filled. This helps most on network-backed disks, where the latency of a
+  read dominates. The budget has to hold three blocks per run instead of
+  one. The records of the runs of a `key` sort are still read with
+  `pickle.load`, so only their writes are asynchronous.
+* `binary_external_sort` sorts fixed-width binary records (e.g. a uint64
+  key followed by a payload) described by a NumPy dtype. It memory-maps the
+  input with `np.memmap`, sorts run-sized slices with `np.argsort` on the key
+  field and writes the runs as raw arrays. The merge is vectorized: it reads
+  a block of every run, writes out all the records up to the smallest last
+  key among the blocks, and sorts them with a stable `np.argsort`, instead of
+  pushing every record through `heapq`.
+* `external_sort` returns stats about the runs (count and length in lines),
+  the number of merge passes and the bytes read and written, so that we can
+  compare the I/O volume of the run generators.
+
+With `num_workers` > 1, the memory-budgeted mode uses a process pool:
+
+* The input is cut into chunks at line-aligned byte offsets (seek to the
+  target offset and skip to the end of the line). Each worker reads a chunk,
+  sorts it and writes it out as a run. The chunk size is picked so that
+  `num_workers` chunks fit in the budget at once.
+* The runs are sorted as bytes, which for UTF-8 gives the same order as
+  sorting the decoded lines, so we never decode the input.
+* The merge passes that bring the number of runs down to `max_fan_in` merge
+  independent groups of runs, so they run in parallel.
+* The final merge is range-partitioned. Each worker returns a sample of its
+  sorted run, and we pick `num_workers - 1` splitters from the samples. Each
+  worker binary searches every run for the start of its key range, merges
+  the range into its own output piece, and the pieces are concatenated.
+
+Run tests:
+
+pytest external_merge_sort.py
+
 Sources:
 * http://web.archive.org/web/20230202171450/https://www.geeksforgeeks.org/external-sorting/
 * http://web.archive.org/web/20230202171737/https://www.geeksforgeeks.org/internal-implementation-of-linux-sort-command/
@@ -18,11 +93,35 @@ Sources:
 * http://web.archive.org/web/20230202171847/http://vkundeti.blogspot.com/2008/03/tech-algorithmic-details-of-unix-sort.html
 * http://web.archive.org/web/20230202172221/https://www.geeksforgeeks.org/merge-sort-using-multi-threading/
 """
+import concurrent.futures
 import heapq
+import io
+import multiprocessing
+import os
+import pickle
 import psutil
+import re
+import shutil
 import string
+import sys
+import tempfile
 import numpy as np
 
+# Fraction of the available RAM used when no `memory_budget` is given.
+MEMORY_FRACTION = 0.5
+DEFAULT_MAX_FAN_IN = 64
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# Approximate memory used by a line in a run on top of its length:
+# an empty str plus a pointer in the list.
+_LINE_OVERHEAD = sys.getsizeof("") + 8
+# Same for a (key, line) record, which also needs a tuple.
+_RECORD_OVERHEAD = _LINE_OVERHEAD + sys.getsizeof((None, None))
+_BYTES_LINE_OVERHEAD = sys.getsizeof(b"") + 8
+
+# Number of lines sampled from each run to pick the splitters.
+_SAMPLES_PER_RUN = 64
+
 
 def _get_partition_file(idx):
 	return "partition{idx}.txt".format(idx=idx)
@@ -94,9 +193,609 @@ def merge(output_file, num_partitions):
 	fout.close()
 
 
-def external_sort(input_file, output_file, partition_size, num_partitions):
-	partition_and_sort(input_file, partition_size, num_partitions)
-	merge(output_file, num_partitions)
+def _default_memory_budget():
+	return int(psutil.virtual_memory().available * MEMORY_FRACTION)
+
+
+def _read_lines(input_file, buffer_size):
+	with open(input_file, "r", buffering=buffer_size) as fin:
+		while True:
+			block = fin.readlines(buffer_size)
+			if not block:
+				break
+			# Only the last line of the file can be missing a newline.
+			if not block[-1].endswith("\n"):
+				block[-1] += "\n"
+			yield from block
+
+
+# The leading number of a field in `sort -n`: optional blanks, an optional
+# minus sign and digits with an optional decimal point. Unlike `float`, it
+# doesn't accept "nan", "inf", exponents or underscores, so every key is a
+# finite number (a NaN key would break the ordering of the sort and the merge).
+_NUMBER = re.compile(r"\s*(-?(?:\d+(?:\.\d*)?|\.\d+))")
+
+def field_key(field, separator=None, numeric=False):
+	"""Returns a key like `sort -k field,field -t separator [-n]`."""
+	assert field >= 1
+
+	def key(line):
+		fields = line.split(separator)
+		value = fields[field - 1] if field <= len(fields) else ""
+		if not numeric:
+			return value
+		match = _NUMBER.match(value)
+		return float(match.group(1)) if match else 0.0
+
+	return key
+
+
+def _records(input_file, buffer_size, key):
+	lines = _read_lines(input_file, buffer_size)
+	if key is None:
+		return lines
+	# Decorate each line with its key once, so that the merge
+	# compares the stored keys instead of computing them again.
+	return ((key(line[:-1]), line) for line in lines)
+
+
+def _record_size(record):
+	if isinstance(record, str):
+		return len(record) + _LINE_OVERHEAD
+	key, line = record
+	return sys.getsizeof(key) + len(line) + _RECORD_OVERHEAD
+
+
+def _open_run(run_file, decorated, buffer_size):
+	"""Returns a run file and a function that writes a record to it."""
+	if not decorated:
+		fout = open(run_file, "w", buffering=buffer_size)
+		return fout, fout.write
+	fout = open(run_file, "wb", buffering=buffer_size)
+	return fout, lambda record: fout.write(
+		pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+
+def _load_records(fin):
+	while True:
+		try:
+			yield pickle.load(fin)
+		except EOFError:
+			return
+
+
+def _write_run(records, run_dir, run_files, run_lengths, buffer_size,
+		decorated, reverse):
+	records.sort(reverse=reverse)
+	run_file = os.path.join(run_dir, f"run{len(run_files)}.txt")
+	fout, write = _open_run(run_file, decorated, buffer_size)
+	with fout:
+		if decorated:
+			for record in records:
+				write(record)
+		else:
+			fout.writelines(records)
+	run_files.append(run_file)
+	run_lengths.append(len(records))
+
+
+def generate_runs(input_file, run_dir, memory_budget, buffer_size,
+		key=None, reverse=False):
+	"""Writes sorted runs that each fit in `memory_budget` bytes."""
+	decorated = key is not None
+	run_files = []
+	run_lengths = []
+	records = []
+	run_bytes = 0
+	for record in _records(input_file, buffer_size, key):
+		records.append(record)
+		run_bytes += _record_size(record)
+		if run_bytes >= memory_budget:
+			_write_run(records, run_dir, run_files, run_lengths, buffer_size,
+				decorated, reverse)
+			records = []
+			run_bytes = 0
+	if records:
+		_write_run(records, run_dir, run_files, run_lengths, buffer_size,
+			decorated, reverse)
+	return run_files, run_lengths
+
+
+class _Reversed:
+	"""Record with the reverse order."""
+
+	__slots__ = ("record",)
+
+	def __init__(self, record):
+		self.record = record
+
+	def __lt__(self, other):
+		return other.record < self.record
+
+
+def replacement_selection_runs(input_file, run_dir, memory_budget, buffer_size,
+		key=None, reverse=False):
+	"""Writes sorted runs with replacement selection."""
+	decorated = key is not None
+	run_files = []
+	run_lengths = []
+	records = _records(input_file, buffer_size, key)
+	if reverse:
+		# heapq only has a min-heap, so we invert the order of the records.
+		records = map(_Reversed, records)
+
+	# Fill the budget. Afterwards, we push or hold back one record for every
+	# record that we pop, so the heap and the held back records stay about
+	# the same size.
+	heap = []
+	heap_bytes = 0
+	for record in records:
+		heap.append(record)
+		heap_bytes += _record_size(record.record if reverse else record)
+		if heap_bytes >= memory_budget:
+			break
+	heapq.heapify(heap)
+
+	while heap:
+		next_run = []
+		run_length = 0
+		run_file = os.path.join(run_dir, f"run{len(run_files)}.txt")
+		fout, write = _open_run(run_file, decorated, buffer_size)
+		with fout:
+			while heap:
+				record = heap[0]
+				write(record.record if reverse else record)
+				run_length += 1
+				next_record = next(records, None)
+				if next_record is None:
+					heapq.heappop(heap)
+				elif not next_record < record:
+					heapq.heapreplace(heap, next_record)
+				else:
+					heapq.heappop(heap)
+					next_run.append(next_record)
+		run_files.append(run_file)
+		run_lengths.append(run_length)
+		heap = next_run
+		heapq.heapify(heap)
+	return run_files, run_lengths
+
+
+RUN_GENERATORS = {
+	"fixed": generate_runs,
+	"replacement_selection": replacement_selection_runs
+}
+
+
+def _total_size(files):
+	return sum(os.path.getsize(f) for f in files)
+
+
+def _stats(input_file, run_bytes, run_lengths, num_merge_passes):
+	input_bytes = os.path.getsize(input_file)
+	return {
+		"num_runs": len(run_lengths),
+		"min_run_length": min(run_lengths, default=0),
+		"max_run_length": max(run_lengths, default=0),
+		"avg_run_length": sum(run_lengths) / max(1, len(run_lengths)),
+		"num_merge_passes": num_merge_passes,
+		# Run generation reads the input and writes the runs. Every
+		# merge pass reads and writes all the data once.
+		"io_bytes": input_bytes + run_bytes + 2 * run_bytes * num_merge_passes
+	}
+
+
+def _prefetch_lines(fin, buffer_size, pool):
+	"""Yields the lines of `fin` while the next block is read on `pool`."""
+	next_block = pool.submit(fin.readlines, buffer_size)
+	while True:
+		block = next_block.result()
+		if not block:
+			return
+		next_block = pool.submit(fin.readlines, buffer_size)
+		yield from block
+
+
+def _write_lines(fout, lines, buffer_size, pool):
+	"""Writes a block of `lines` on `pool` while the next block is filled."""
+	if pool is None:
+		fout.writelines(lines)
+		return
+	pending = None
+	block = []
+	block_bytes = 0
+	for line in lines:
+		block.append(line)
+		block_bytes += len(line)
+		if block_bytes >= buffer_size:
+			# Keep the blocks in order.
+			if pending:
+				pending.result()
+			pending = pool.submit(fout.writelines, block)
+			block = []
+			block_bytes = 0
+	if pending:
+		pending.result()
+	fout.writelines(block)
+
+
+def merge_runs(run_files, output_file, buffer_size, decorated=False,
+		reverse=False, undecorate=True, async_io=False):
+	fins = [open(run_file, "rb", buffering=buffer_size) for run_file in run_files]
+	pool = None
+	if async_io:
+		# A read in flight for every run plus a write.
+		pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(fins) + 1)
+
+	if not decorated:
+		# Comparing the UTF-8 bytes gives the same order as comparing
+		# the lines, so we can skip decoding.
+		runs = fins
+		if async_io:
+			runs = [_prefetch_lines(fin, buffer_size, pool) for fin in fins]
+		with open(output_file, "wb", buffering=buffer_size) as fout:
+			_write_lines(
+				fout, heapq.merge(*runs, reverse=reverse), buffer_size, pool)
+	else:
+		records = heapq.merge(
+			*[_load_records(fin) for fin in fins], reverse=reverse)
+		fout, write = _open_run(output_file, not undecorate, buffer_size)
+		with fout:
+			if undecorate:
+				_write_lines(
+					fout, (line for _, line in records), buffer_size, pool)
+			else:
+				for record in records:
+					write(record)
+
+	if pool:
+		pool.shutdown()
+	for fin in fins:
+		fin.close()
+
+
+def multi_pass_merge(run_files, output_file, run_dir, max_fan_in, merge):
+	"""Merges at most `max_fan_in` runs at a time until one run is left.
+
+	`merge(run_files, output_file, final)` merges a group of runs, where
+	`final` is True for the merge that writes `output_file`.
+	"""
+	assert max_fan_in >= 2
+	num_passes = 0
+	while len(run_files) > max_fan_in:
+		merged_run_files = []
+		for i in range(0, len(run_files), max_fan_in):
+			group = run_files[i:i + max_fan_in]
+			merged_run_file = os.path.join(
+				run_dir, f"pass{num_passes}_run{len(merged_run_files)}.txt")
+			merge(group, merged_run_file, False)
+			for run_file in group:
+				os.remove(run_file)
+			merged_run_files.append(merged_run_file)
+		run_files = merged_run_files
+		num_passes += 1
+	merge(run_files, output_file, True)
+	return num_passes + 1
+
+
+def _chunk_size(input_file, memory_budget, buffer_size):
+	"""Returns the number of input bytes that fit in `memory_budget` once split into lines."""
+	# The chunk is in memory twice: as one bytes object and as a list of lines.
+	with open(input_file, "rb") as fin:
+		sample = fin.read(buffer_size)
+	avg_line_len = max(1, len(sample) / max(1, sample.count(b"\n")))
+	return max(1, int(memory_budget / (2 + _BYTES_LINE_OVERHEAD / avg_line_len)))
+
+
+def _line_aligned_offsets(input_file, chunk_size):
+	size = os.path.getsize(input_file)
+	offsets = [0]
+	with open(input_file, "rb") as fin:
+		while offsets[-1] + chunk_size < size:
+			fin.seek(offsets[-1] + chunk_size)
+			fin.readline()
+			if fin.tell() >= size:
+				break
+			offsets.append(fin.tell())
+	offsets.append(size)
+	return offsets
+
+
+def _sort_chunk(input_file, start, end, run_file, buffer_size):
+	with open(input_file, "rb") as fin:
+		fin.seek(start)
+		lines = io.BytesIO(fin.read(end - start)).readlines()
+	if lines and not lines[-1].endswith(b"\n"):
+		lines[-1] += b"\n"
+	lines.sort()
+	with open(run_file, "wb", buffering=buffer_size) as fout:
+		fout.writelines(lines)
+	step = max(1, len(lines) // _SAMPLES_PER_RUN)
+	return lines[step - 1::step], len(lines)
+
+
+def _line_start(fin, offset):
+	"""Returns the offset of the first line that starts at or after `offset`."""
+	if offset == 0:
+		return 0
+	fin.seek(offset - 1)
+	fin.readline()
+	return fin.tell()
+
+
+def _lower_bound(fin, size, key):
+	"""Returns the offset of the first line >= `key` in a sorted file."""
+	lo = 0
+	hi = size
+	while lo < hi:
+		mid = (lo + hi) // 2
+		fin.seek(_line_start(fin, mid))
+		line = fin.readline()
+		if line and line < key:
+			lo = mid + 1
+		else:
+			hi = mid
+	return _line_start(fin, lo)
+
+
+def _read_range(fin, size, lo, hi):
+	"""Yields the lines in [lo, hi) of a sorted file (None is unbounded)."""
+	if lo is not None:
+		fin.seek(_lower_bound(fin, size, lo))
+	for line in fin:
+		if hi is not None and line >= hi:
+			break
+		yield line
+
+
+def _merge_range(run_files, lo, hi, piece_file, buffer_size):
+	fins = [open(run_file, "rb", buffering=buffer_size) for run_file in run_files]
+	ranges = []
+	for run_file, fin in zip(run_files, fins):
+		ranges.append(_read_range(fin, os.path.getsize(run_file), lo, hi))
+	with open(piece_file, "wb", buffering=buffer_size) as fout:
+		fout.writelines(heapq.merge(*ranges))
+	for fin in fins:
+		fin.close()
+
+
+def parallel_external_sort(input_file, output_file, run_dir, memory_budget,
+		max_fan_in, num_workers):
+	# Every worker holds a chunk (or the buffers of a merge) at once.
+	worker_budget = memory_budget // num_workers
+	buffer_size = max(1, min(DEFAULT_BUFFER_SIZE, worker_budget // (max_fan_in + 1)))
+	chunk_size = _chunk_size(input_file, worker_budget, buffer_size)
+	offsets = _line_aligned_offsets(input_file, chunk_size)
+
+	with multiprocessing.Pool(num_workers) as pool:
+		args = []
+		run_files = []
+		for i in range(len(offsets) - 1):
+			run_file = os.path.join(run_dir, f"run{i}.txt")
+			args.append((input_file, offsets[i], offsets[i + 1], run_file, buffer_size))
+			run_files.append(run_file)
+		samples = []
+		run_lengths = []
+		for run_samples, run_length in pool.starmap(_sort_chunk, args):
+			samples.extend(run_samples)
+			run_lengths.append(run_length)
+		run_bytes = _total_size(run_files)
+
+		num_passes = 0
+		while len(run_files) > max_fan_in:
+			args = []
+			for i in range(0, len(run_files), max_fan_in):
+				merged_run_file = os.path.join(
+					run_dir, f"pass{num_passes}_run{len(args)}.txt")
+				args.append((run_files[i:i + max_fan_in], merged_run_file, buffer_size))
+			pool.starmap(merge_runs, args)
+			for run_file in run_files:
+				os.remove(run_file)
+			run_files = [merged_run_file for _, merged_run_file, _ in args]
+			num_passes += 1
+		num_passes += 1
+
+		# The splitters cut the key space into `num_workers` ranges
+		# with roughly the same number of lines. An empty input has no
+		# samples and is a single empty range.
+		samples.sort()
+		splitters = []
+		for i in range(1, num_workers if samples else 1):
+			splitter = samples[i * len(samples) // num_workers]
+			if not splitters or splitter != splitters[-1]:
+				splitters.append(splitter)
+		bounds = [None] + splitters + [None]
+
+		args = []
+		for i in range(len(bounds) - 1):
+			piece_file = os.path.join(run_dir, f"piece{i}.txt")
+			args.append((run_files, bounds[i], bounds[i + 1], piece_file, buffer_size))
+		pool.starmap(_merge_range, args)
+
+	with open(output_file, "wb") as fout:
+		for _, _, _, piece_file, _ in args:
+			with open(piece_file, "rb") as fin:
+				shutil.copyfileobj(fin, fout, DEFAULT_BUFFER_SIZE)
+
+	return _stats(input_file, run_bytes, run_lengths, num_passes)
+
+
+def external_sort(input_file, output_file, partition_size=None,
+		num_partitions=None, memory_budget=None,
+		max_fan_in=DEFAULT_MAX_FAN_IN, tmp_dir=None, num_workers=1,
+		run_generator="fixed", key=None, reverse=False, field=None,
+		separator=None, numeric=False, async_io=False):
+	if field is not None:
+		if key is not None:
+			raise ValueError("Pass either key or field, not both")
+		key = field_key(field, separator, numeric)
+	ordered = key is not None or reverse
+
+	if partition_size is not None or num_partitions is not None:
+		if ordered:
+			raise ValueError("key and reverse need the memory-budgeted mode")
+		partition_and_sort(input_file, partition_size, num_partitions)
+		merge(output_file, num_partitions)
+		return
+
+	if memory_budget is None:
+		memory_budget = _default_memory_budget()
+
+	if num_workers > 1:
+		if run_generator != "fixed":
+			raise ValueError(f"{run_generator} runs can't be generated in parallel")
+		if ordered:
+			raise ValueError("key and reverse are not supported in parallel")
+		with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+			return parallel_external_sort(input_file, output_file, run_dir,
+				memory_budget, max_fan_in, num_workers)
+
+	# Every open run (and the output) gets a buffer, so the buffers
+	# of a merge have to fit in the budget too.
+	num_buffers = max_fan_in + 1
+	if async_io:
+		num_buffers *= 3
+	buffer_size = max(1, min(DEFAULT_BUFFER_SIZE, memory_budget // num_buffers))
+
+	with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+		run_files, run_lengths = RUN_GENERATORS[run_generator](
+			input_file, run_dir, memory_budget, buffer_size, key, reverse)
+		run_bytes = _total_size(run_files)
+
+		def merge_group(group, merged_file, final):
+			merge_runs(group, merged_file, buffer_size, key is not None, reverse,
+				undecorate=final, async_io=async_io)
+
+		num_merge_passes = multi_pass_merge(
+			run_files, output_file, run_dir, max_fan_in, merge_group)
+	return _stats(input_file, run_bytes, run_lengths, num_merge_passes)
+
+
+def _record_keys(records, order):
+	return records if order is None else records[order]
+
+
+def _merge_record_runs(run_files, output_file, dtype, order, block_size):
+	"""Merges runs of records a block at a time with NumPy.
+
+	We take the next block of every run. Every record with a key <= the
+	smallest last key among the blocks of the runs that have more records
+	is in its final position relative to the records that we haven't read
+	yet, so we sort those records together and write them out.
+	"""
+	runs = []
+	for run_file in run_files:
+		if os.path.getsize(run_file) > 0:
+			runs.append(np.memmap(run_file, dtype=dtype, mode="r"))
+	starts = [0 for _ in runs]
+	with open(output_file, "wb") as fout:
+		while any(start < len(run) for start, run in zip(starts, runs)):
+			blocks = []
+			bound = None
+			for start, run in zip(starts, runs):
+				block = run[start:start + block_size]
+				blocks.append(block)
+				if start + block_size < len(run):
+					last = _record_keys(block, order)[-1]
+					if bound is None or last < bound:
+						bound = last
+
+			pieces = []
+			for i, block in enumerate(blocks):
+				if bound is None:
+					n = len(block)
+				else:
+					n = np.searchsorted(_record_keys(block, order), bound, side="right")
+				pieces.append(block[:n])
+				starts[i] += n
+
+			# The pieces are sorted, so the stable sort (timsort) only
+			# has to merge them.
+			merged = np.concatenate(pieces)
+			merged = merged[np.argsort(_record_keys(merged, order), kind="stable")]
+			merged.tofile(fout)
+
+
+def binary_external_sort(input_file, output_file, dtype, order=None,
+		memory_budget=None, max_fan_in=DEFAULT_MAX_FAN_IN, tmp_dir=None):
+	"""Sorts a file of fixed-width binary records.
+
+	`dtype` is the NumPy dtype of a record. For a structured dtype, the records
+	are sorted by the field `order` (the first field by default).
+	"""
+	dtype = np.dtype(dtype)
+	if dtype.names is not None and order is None:
+		order = dtype.names[0]
+	if memory_budget is None:
+		memory_budget = _default_memory_budget()
+
+	input_bytes = os.path.getsize(input_file)
+	if input_bytes % dtype.itemsize != 0:
+		raise ValueError(f"{input_file} is not a whole number of {dtype} records")
+	if input_bytes == 0:
+		open(output_file, "wb").close()
+		return _stats(input_file, 0, [], 0)
+
+	# A run is in memory as the records, the sorted indices and the
+	# sorted records. A merge holds a block of every run the same way.
+	record_bytes = 2 * dtype.itemsize + 8
+	run_length = max(1, memory_budget // record_bytes)
+	block_size = max(1, memory_budget // (max_fan_in * record_bytes))
+
+	records = np.memmap(input_file, dtype=dtype, mode="r")
+	with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+		run_files = []
+		run_lengths = []
+		for start in range(0, len(records), run_length):
+			run = np.array(records[start:start + run_length])
+			run = run[np.argsort(_record_keys(run, order), kind="stable")]
+			run_file = os.path.join(run_dir, f"run{len(run_files)}.bin")
+			run.tofile(run_file)
+			run_files.append(run_file)
+			run_lengths.append(len(run))
+		del records
+
+		def merge_group(group, merged_file, final):
+			_merge_record_runs(group, merged_file, dtype, order, block_size)
+
+		num_merge_passes = multi_pass_merge(
+			run_files, output_file, run_dir, max_fan_in, merge_group)
+	return _stats(input_file, input_bytes, run_lengths, num_merge_passes)
+
+
+########
+# Tests
+########
+
+
+import pytest
+
+
+@pytest.fixture
+def lines(tmp_path, monkeypatch):
+	# The partitions of the legacy mode are written to the working directory.
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(seed=0)
+	alphabet = [s for s in string.ascii_lowercase]
+	lines = ["".join(rng.choice(alphabet, size=5)) + "\n" for _ in range(100)]
+	with open("input.txt", "w") as fout:
+		fout.writelines(lines)
+	return lines
+
+
+def test_legacy_partitions(lines):
+	external_sort("input.txt", "output.txt", 10, 10)
+	with open("output.txt") as fin:
+		assert fin.readlines() == sorted(lines)
+
+
+def test_memory_budget(lines):
+	for run_generator in RUN_GENERATORS:
+		stats = external_sort("input.txt", "output.txt", memory_budget=1000,
+			max_fan_in=2, tmp_dir=".", run_generator=run_generator)
+		with open("output.txt") as fin:
+			assert fin.readlines() == sorted(lines)
+		assert stats["num_merge_passes"] > 1
 
 
 if __name__ == "__main__":
@@ -114,4 +813,8 @@ if __name__ == "__main__":
 	with open(input_file, "w") as fin:
 		fin.write("\n".join(words))
 
-	external_sort(input_file, output_file, partition_size, num_partitions)
+	# A small budget and fan-in, so that the merge takes multiple passes.
+	for run_generator in RUN_GENERATORS:
+		stats = external_sort(input_file, output_file, memory_budget=100000,
+			max_fan_in=4, run_generator=run_generator)
+		print(run_generator, stats)
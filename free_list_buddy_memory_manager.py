@@ -0,0 +1,369 @@
+"""Buddy memory allocator with a free list per order.
+
+Like buddy_memory_manager.py, except that we don't keep a tree of
+2 * `size` - 1 Python ints and we don't walk the tree from the root on
+every call. Instead, we keep the free blocks of each size in their own free
+list, like the Linux page allocator.
+
+A block of order k has size `min_block` * 2^k and starts at a multiple of
+its size. The whole arena is a single block of order `max_order`. The buddy
+of a block of order k is the other half of the block of order k + 1 that
+contains it, so its start is the start of the block with the bit of the
+block size flipped: `start ^ (min_block << k)`.
+
+The malloc method rounds the request up to the smallest order that fits
+and pops a block from the free list of the smallest order at or above it
+that is not empty. An integer bitmap has bit k set if the free list of
+order k is not empty, so we find that order with a couple of bit
+operations instead of a search. If the block is larger than the request,
+then we split it in half: we keep the lower half and push the upper half
+(its buddy) onto the free list of the order below, until the block has the
+order of the request.
+
+The free method looks up the order of the block, which malloc recorded for
+its start address. If the buddy of the block is free, then it removes the
+buddy from its free list and merges the 2 blocks into a block of the next
+order. It repeats until the buddy is not free or the block is the whole
+arena and then pushes the block onto the free list of its order.
+
+We find out if the buddy of a block is free with a bitmap per order that
+has 1 bit for each pair of buddies. The bit is the XOR of "block A is free"
+and "block B is free", so we flip it whenever one of the 2 blocks is pushed
+onto or popped from the free list. When we flip it while freeing a block,
+the bit is 0 if the buddy is also free and 1 if it isn't. The bitmap of
+order k has `size` / (`min_block` * 2^(k + 1)) bits, so all the bitmaps
+together have fewer than `size` / `min_block` bits.
+
+Notes:
+* The free list of an order is a dict from the start of a block to None
+  that we use as a set with O(1) insert, delete and pop (popitem pops the
+  most recently pushed block). A real allocator threads the free lists
+  through the free blocks themselves, so the free lists take no extra space.
+* `start_to_order` maps the start of a reserved block to its order, like
+  the "size map" in memory_manager.py.
+* A malloc splits at most `max_order` times and a free merges at most
+  `max_order` times, but neither walks a path from the root of a tree,
+  so a request for a block of the largest free order takes O(1) time and
+  there is no 2 * `size` - 1 tree to build, even for an arena of size 2^30.
+* `min_block` is the smallest block that we hand out. A larger `min_block`
+  makes the bitmaps smaller and the splits fewer at the cost of more
+  internal fragmentation for small requests.
+
+Run tests:
+
+pytest free_list_buddy_memory_manager.py
+
+See also:
+* buddy_memory_manager.py
+* ostep_free_space_management.md
+
+Sources:
+* https://www.kernel.org/doc/gorman/html/understand/understand009.html
+* Wikipedia (https://web.archive.org/web/20230813151519/https://en.wikipedia.org/wiki/Buddy_memory_allocation)
+* A Fast Storage Allocator, Kenneth Knowlton (https://dl.acm.org/doi/pdf/10.1145/365628.365655)
+"""
+
+
+def _is_pow_of_2(x):
+	return (x & (x - 1)) == 0
+
+
+class FreeListBuddyMemoryManager:
+
+	def __init__(self, size, min_block=1):
+		assert size >= 1
+		assert isinstance(size, int)
+		assert _is_pow_of_2(size)
+		assert _is_pow_of_2(min_block) and min_block <= size
+
+		self._size = size
+		self._min_block = min_block
+		self._max_order = (size // min_block).bit_length() - 1
+
+		self._free_lists = [{} for _ in range(self._max_order + 1)]
+		# Bit k is set if the free list of order k is not empty.
+		self._nonempty = 0
+		# 1 bit per pair of buddies of each order below `max_order`.
+		self._bitmaps = [
+			bytearray(-(-(size // (min_block << (k + 1))) // 8))
+			for k in range(self._max_order)]
+		self.start_to_order = {}
+
+		self._push(0, self._max_order)
+
+	def _push(self, start, order):
+		self._free_lists[order][start] = None
+		self._nonempty |= 1 << order
+
+	def _pop(self, order):
+		start, _ = self._free_lists[order].popitem()
+		if not self._free_lists[order]:
+			self._nonempty &= ~(1 << order)
+		return start
+
+	def _remove(self, start, order):
+		del self._free_lists[order][start]
+		if not self._free_lists[order]:
+			self._nonempty &= ~(1 << order)
+
+	def _flip(self, start, order):
+		# Flips the bit of the pair of buddies that contains the block
+		# and returns the new value of the bit.
+		i = (start // self._min_block) >> (order + 1)
+		bitmap = self._bitmaps[order]
+		bitmap[i >> 3] ^= 1 << (i & 7)
+		return (bitmap[i >> 3] >> (i & 7)) & 1
+
+	def malloc(self, size):
+		num_blocks = max(1, -(-size // self._min_block))
+		order = (num_blocks - 1).bit_length()
+		if order > self._max_order:
+			return -1
+
+		# Smallest order at or above `order` with a free block.
+		orders = self._nonempty >> order << order
+		if not orders:
+			return -1
+		k = (orders & -orders).bit_length() - 1
+
+		start = self._pop(k)
+		if k < self._max_order:
+			self._flip(start, k)
+
+		# Splitting.
+		while k > order:
+			k -= 1
+			buddy = start + (self._min_block << k)
+			self._push(buddy, k)
+			self._flip(buddy, k)
+
+		self.start_to_order[start] = order
+
+		return start
+
+	def free(self, start):
+		if start not in self.start_to_order:
+			return False
+
+		order = self.start_to_order.pop(start)
+
+		# Coalescing.
+		while order < self._max_order and self._flip(start, order) == 0:
+			# The buddy is free too.
+			buddy = start ^ (self._min_block << order)
+			self._remove(buddy, order)
+			start = min(start, buddy)
+			order += 1
+
+		self._push(start, order)
+
+		return True
+
+	def size(self, start):
+		if start not in self.start_to_order:
+			return -1
+		return self._min_block << self.start_to_order[start]
+
+	@property
+	def free_list(self):
+		# for testing.
+		result = []
+		for order, free_list in enumerate(self._free_lists):
+			for start in free_list:
+				result.append([start, start + (self._min_block << order)])
+		result.sort()
+		return result
+
+
+########
+# Tests
+########
+
+
+import pytest
+import random
+
+
+def _max_size(buddy):
+	if not buddy._nonempty:
+		return 0
+	return buddy._min_block << (buddy._nonempty.bit_length() - 1)
+
+
+@pytest.fixture
+def buddy():
+	return FreeListBuddyMemoryManager(1024)
+
+
+def test_init(buddy):
+	assert buddy.free_list == [[0, 1024]]
+
+
+def test_malloc_ok(buddy):
+	# Reserve [0, 512)
+	start0 = buddy.malloc(512)
+	assert start0 == 0
+	assert buddy.free_list == [[512, 1024]]
+
+
+def test_malloc_fail(buddy):
+	# Try to reserve [0, 10000)
+	start0 = buddy.malloc(10000)
+	assert start0 == -1
+	# Nothing changes.
+	assert buddy.free_list == [[0, 1024]]
+
+
+def test_free_ok(buddy):
+	start0 = buddy.malloc(512)
+	assert buddy.free(start0)
+	assert buddy.free_list == [[0, 1024]]
+
+
+def test_free_fail(buddy):
+	# Reserve [0, 512)
+	start0 = buddy.malloc(512)
+	# Invalid address.
+	assert not buddy.free(start0 + 1)
+	# Reserved space starting at `start0` remain
+	# reserved.
+	assert buddy.free_list == [[512, 1024]]
+
+
+def test_multiple_malloc(buddy):
+	# Reserve [0, 512)
+	start0 = buddy.malloc(512)
+	# Reserve [512, 640)
+	start1 = buddy.malloc(120)
+	assert start1 == 512
+	assert buddy.free_list == [[640, 768], [768, 1024]]
+
+
+def test_fragmentation(buddy):
+	# Reserve [0, 512)
+	start0 = buddy.malloc(512)
+	# Reserve [512, 640)
+	start1 = buddy.malloc(120)
+	# Free [0, 512)
+	assert buddy.free(start0)
+	assert buddy.free_list == [[0, 512], [640, 768], [768, 1024]]
+	start2 = buddy.malloc(520)
+	# We have enough free space across the ranges, but
+	# not in any single range.
+	assert start2 == -1
+
+
+def test_coalesce(buddy):
+	# Reserve [0, 512)
+	start0 = buddy.malloc(512)
+	assert start0 == 0
+	# Reserve [512, 640)
+	start1 = buddy.malloc(120)
+	assert start1 == 512
+	# Free [0, 512)
+	assert buddy.free(start0)
+	# Free [512, 640)
+	# [512, 640) is merged with its buddy [640, 768), then
+	# with [768, 1024) and then with [0, 512).
+	assert buddy.free(start1)
+	assert buddy.free_list == [[0, 1024]]
+	assert buddy._nonempty == 1 << 10
+	assert not any(any(bitmap) for bitmap in buddy._bitmaps)
+
+
+def test_min_block():
+	buddy = FreeListBuddyMemoryManager(1 << 30, min_block=4096)
+	# 1 bit per pair of blocks per order: fewer than 2^18 bits
+	# (plus rounding up each of the 18 bitmaps to whole bytes).
+	assert sum(len(bitmap) for bitmap in buddy._bitmaps) < (1 << 18) // 8 + 18
+	start0 = buddy.malloc(1)
+	assert buddy.size(start0) == 4096
+	start1 = buddy.malloc(5000)
+	assert start1 == 8192
+	assert buddy.size(start1) == 8192
+	assert buddy.free(start0)
+	assert buddy.free(start1)
+	assert buddy.free_list == [[0, 1 << 30]]
+
+
+def test_fuzz(buddy):
+	"""Fuzz test.
+
+	Same as test_fuzz in buddy_memory_manager.py, except that we
+	also check that the reserved blocks never overlap.
+	"""
+	random.seed(0)
+	starts = []
+	reserved = [False] * 1024
+	for thd in [0.25, 0.5, 0.75]:
+		for _ in range(10000):
+			r = random.random()
+			max_size = _max_size(buddy)
+			if (max_size > 0) and ((not starts) or (r <= thd)):
+				# Sample an index in [1, max_size] inclusive.
+				size = random.randint(1, max_size)
+				start = buddy.malloc(size)
+				assert start != -1
+				for i in range(start, start + buddy.size(start)):
+					assert not reserved[i]
+					reserved[i] = True
+				starts.append(start)
+			else:
+				# Sample an index in [0, len(starts) - 1] inclusive.
+				i = random.randint(0, len(starts) - 1)
+				start = starts.pop(i)
+				for i in range(start, start + buddy.size(start)):
+					reserved[i] = False
+				assert buddy.free(start)
+
+	random.shuffle(starts)
+	while starts:
+		start = starts.pop()
+		buddy.free(start)
+
+	assert buddy.free_list == [[0, 1024]]
+
+
+def test_cloudwu():
+	b = FreeListBuddyMemoryManager(32)
+
+	m1 = b.malloc(4)
+	assert m1 == 0
+	assert b.size(m1) == 4
+
+	m2 = b.malloc(9)
+	assert m2 == 16
+	assert b.size(m2) == 16
+
+	m3 = b.malloc(3)
+	assert m3 == 4
+	assert b.size(m3) == 4
+
+	m4 = b.malloc(7)
+	assert m4 == 8
+	assert b.size(m4) == 8
+	assert b.free_list == []
+
+	assert b.free(m3)
+	assert b.free(m1)
+	assert b.free_list == [[0, 8]]
+
+	assert b.free(m4)
+	assert b.free_list == [[0, 16]]
+
+	assert b.free(m2)
+	assert b.free_list == [[0, 32]]
+
+	m5 = b.malloc(32)
+	assert m5 == 0
+	assert b.size(m5) == 32
+
+	assert b.free(m5)
+
+	m6 = b.malloc(0)
+	assert m6 == 0
+	assert b.size(m6) == 1
+	assert b.free_list == [[1, 2], [2, 4], [4, 8], [8, 16], [16, 32]]
+
+	assert b.free(m6)
+	assert b.free_list == [[0, 32]]
@@ -8,14 +8,46 @@ Notes:
   cases for linked list operations
 * We have 2 helper methods: _remove_node_from_ll and _insert_node_into_ll_before_tail
 * We need to define __init__, __len__, __contains__, __getitem__, __setitem__, move_to_end, popitem
+  (cache_eviction_policies.py also uses __delitem__ and __iter__)
+* LRUCache is not thread-safe: a get moves a node in the linked list, so concurrent gets can
+  corrupt the list.
+* ShardedLRUCache is a thread-safe LRU cache with lock striping: it hashes each key to one of
+  num_shards independent LRUCache segments, each with its own lock, so threads that touch
+  different shards don't wait for each other. The capacity is split across the shards, so the
+  total capacity is the same, but each shard evicts its own least recently used key (which
+  is not necessarily the least recently used key overall).
+* A weigher bounds the memory of the cache instead of the number of keys: weigher(key, value)
+  returns the weight of an entry (e.g., its size in bytes) and put evicts the least recently
+  used keys until the total weight is at most max_weight. We keep the weight of each key and
+  update the total weight on every insert and eviction, so we never sum the weights.
+* ArrayLRUCache is an LRU cache for 64-bit integer keys and values without an object per entry.
+  Each entry has a slot and its key, value, prev and next are stored in preallocated
+  array("q") columns indexed by the slot, so an entry costs 32 bytes plus 16 bytes for the
+  index instead of a Node, a dict entry and boxed ints (over 200 bytes), and the garbage
+  collector has nothing to track.
+  * The linked list uses the slot capacity as a single dummy node: next of the dummy node is
+    the least recently used slot and prev of the dummy node is the most recently used slot.
+  * The unused slots form a free list that is linked through the next column.
+  * The index from key to slot is an open addressing hash table in another array with linear
+    probing and a multiplicative (Fibonacci) hash. It has at least 2x as many buckets as
+    slots, so the probe sequences stay short. A delete shifts the following entries of the
+    probe sequence back instead of leaving a tombstone, so lookups never slow down.
+
+Run tests:
+
+pytest lru_cache.py
 
 Sources:
 * Solves https://leetcode.com/problems/lru-cache/
 * https://leetcode.com/problems/lru-cache/discuss/45926/Python-Dict-%2B-Double-LinkedList
 """
+import array
+import threading
 
 class Node:
 
+    __slots__ = ("key", "value", "next", "prev")
+
     def __init__(self):
         self.key = None
         self.value = None
@@ -68,24 +100,44 @@ class OrderedDict:
     def __contains__(self, key):
         return (key in self.key_to_node)
 
+    def __delitem__(self, key):
+        node = self.key_to_node.pop(key)
+        self._remove_node_from_ll(node)
+
+    def __iter__(self):
+        # From least to most recently moved to the end
+        node = self.head.next
+        while node is not self.tail:
+            yield node.key
+            node = node.next
+
     def move_to_end(self, key):
         node = self.key_to_node[key]
         self._remove_node_from_ll(node)
         self._insert_node_into_ll_before_tail(node)
 
     def popitem(self, last):
-        if last:
-            raise NotImplementedError
-        node = self.head.next
+        if len(self.key_to_node) == 0:
+            raise KeyError("popitem(): dictionary is empty")
+        node = self.tail.prev if last else self.head.next
         self._remove_node_from_ll(node)
         self.key_to_node.pop(node.key)
+        return node.key, node.value
 
 
 class LRUCache:
 
-    def __init__(self, capacity: int):
+    def __init__(self, capacity: int, max_weight: int = None, weigher=None):
+        # capacity bounds the number of keys and max_weight bounds the total weight,
+        # where weigher(key, value) is the weight of an entry (1 by default).
+        # Either bound can be None.
         self.capacity = capacity
+        self.max_weight = max_weight
+        self.weigher = weigher
         self.cache = OrderedDict()
+        self.key_to_weight = {}
+        self.weight = 0
+        self.num_evictions = 0
 
     def get(self, key: int) -> int:
         if key not in self.cache:
@@ -95,8 +147,367 @@ class LRUCache:
         return value
         
 
+    def _over_budget(self):
+        if (self.capacity is not None) and (len(self.cache) > self.capacity):
+            return True
+        return (self.max_weight is not None) and (self.weight > self.max_weight)
+
+    def _remove(self, key):
+        del self.cache[key]
+        self.weight -= self.key_to_weight.pop(key)
+
     def put(self, key: int, value: int) -> None:
-        if (key not in self.cache) and (len(self.cache) == self.capacity):
-            self.cache.popitem(last=False)
+        weight = 1 if self.weigher is None else self.weigher(key, value)
+        if key in self.cache:
+            self._remove(key)
+        if (self.max_weight is not None) and (weight > self.max_weight):
+            # The entry would evict everything else and still not fit
+            return
         self.cache[key] = value
-        self.cache.move_to_end(key)
\ No newline at end of file
+        self.key_to_weight[key] = weight
+        self.weight += weight
+        # The new key is the most recently used, so it is evicted last and the loop
+        # stops before it.
+        while self._over_budget():
+            evicted_key, _ = self.cache.popitem(last=False)
+            self.weight -= self.key_to_weight.pop(evicted_key)
+            self.num_evictions += 1
+
+
+class ShardedLRUCache:
+
+    def __init__(self, capacity: int, num_shards: int = 16):
+        assert capacity >= 1
+        # Every shard needs room for at least 1 key.
+        num_shards = min(num_shards, capacity)
+        self.capacity = capacity
+        self.shards = []
+        self.locks = []
+        self.shard_stats = []
+        for i in range(num_shards):
+            shard_capacity = capacity // num_shards + (1 if i < capacity % num_shards else 0)
+            self.shards.append(LRUCache(shard_capacity))
+            self.locks.append(threading.Lock())
+            self.shard_stats.append({"hits": 0, "misses": 0, "evictions": 0})
+
+    def _shard(self, key):
+        return hash(key) % len(self.shards)
+
+    def get(self, key: int) -> int:
+        i = self._shard(key)
+        with self.locks[i]:
+            shard = self.shards[i]
+            if key in shard.cache:
+                self.shard_stats[i]["hits"] += 1
+            else:
+                self.shard_stats[i]["misses"] += 1
+            return shard.get(key)
+
+    def put(self, key: int, value: int) -> None:
+        i = self._shard(key)
+        with self.locks[i]:
+            shard = self.shards[i]
+            num_evictions = shard.num_evictions
+            shard.put(key, value)
+            self.shard_stats[i]["evictions"] += shard.num_evictions - num_evictions
+
+    def __len__(self):
+        return sum(len(shard.cache) for shard in self.shards)
+
+    def stats(self):
+        result = []
+        for i in range(len(self.shards)):
+            with self.locks[i]:
+                shard_stats = dict(self.shard_stats[i])
+                shard_stats["size"] = len(self.shards[i].cache)
+                shard_stats["capacity"] = self.shards[i].capacity
+            result.append(shard_stats)
+        return result
+
+
+class ArrayLRUCache:
+
+    EMPTY = -1
+
+    def __init__(self, capacity: int):
+        assert capacity >= 1
+        self.capacity = capacity
+        self.dummy = capacity
+        self.keys = array.array("q", bytes(8 * capacity))
+        self.values = array.array("q", bytes(8 * capacity))
+        self.prev = array.array("q", [self.dummy]) * (capacity + 1)
+        # Links the free slots: slot i points to slot i + 1 and the last one to the dummy node
+        self.next = array.array("q", range(1, capacity + 2))
+        self.next[capacity] = self.dummy
+        self.free_head = 0
+        self.size = 0
+        self.num_bits = max(2 * capacity - 1, 1).bit_length()
+        self.mask = (1 << self.num_bits) - 1
+        self.index = array.array("q", [self.EMPTY]) * (1 << self.num_bits)
+
+    def __len__(self):
+        return self.size
+
+    def _home(self, key):
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self.num_bits)
+
+    def _find(self, key):
+        # Returns the bucket of the key or of the empty bucket where it would go
+        i = self._home(key)
+        while True:
+            slot = self.index[i]
+            if slot == self.EMPTY or self.keys[slot] == key:
+                return i
+            i = (i + 1) & self.mask
+
+    def _delete_bucket(self, i):
+        j = i
+        while True:
+            j = (j + 1) & self.mask
+            slot = self.index[j]
+            if slot == self.EMPTY:
+                break
+            k = self._home(self.keys[slot])
+            # The entry in j can't move to i if its home is cyclically in (i, j]
+            if (i < k <= j) if i <= j else (k > i or k <= j):
+                continue
+            self.index[i] = slot
+            i = j
+        self.index[i] = self.EMPTY
+
+    def _unlink(self, slot):
+        p = self.prev[slot]
+        n = self.next[slot]
+        self.next[p] = n
+        self.prev[n] = p
+
+    def _link_before_dummy(self, slot):
+        p = self.prev[self.dummy]
+        self.next[p] = slot
+        self.prev[self.dummy] = slot
+        self.prev[slot] = p
+        self.next[slot] = self.dummy
+
+    def get(self, key: int) -> int:
+        slot = self.index[self._find(key)]
+        if slot == self.EMPTY:
+            return -1
+        self._unlink(slot)
+        self._link_before_dummy(slot)
+        return self.values[slot]
+
+    def put(self, key: int, value: int) -> None:
+        i = self._find(key)
+        slot = self.index[i]
+        if slot != self.EMPTY:
+            self.values[slot] = value
+            self._unlink(slot)
+            self._link_before_dummy(slot)
+            return
+
+        if self.size == self.capacity:
+            # Reuse the slot of the least recently used key
+            slot = self.next[self.dummy]
+            self._unlink(slot)
+            self._delete_bucket(self._find(self.keys[slot]))
+            # The deletion may have moved the empty bucket for the new key
+            i = self._find(key)
+        else:
+            slot = self.free_head
+            self.free_head = self.next[slot]
+            self.size += 1
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.index[i] = slot
+        self._link_before_dummy(slot)
+
+    def delete(self, key: int) -> None:
+        i = self._find(key)
+        slot = self.index[i]
+        if slot == self.EMPTY:
+            return
+        self._delete_bucket(i)
+        self._unlink(slot)
+        self.next[slot] = self.free_head
+        self.free_head = slot
+        self.size -= 1
+
+########
+# Tests
+########
+
+
+import collections
+import pytest
+import random
+
+
+class ReferenceLRUCache:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cache = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.cache:
+            return -1
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def delete(self, key):
+        self.cache.pop(key, None)
+
+
+def _check_index(cache):
+    # Every key is in the probe sequence from its home bucket and no bucket is
+    # left behind for a deleted key.
+    slots = [slot for slot in cache.index if slot != cache.EMPTY]
+    assert len(slots) == len(set(slots)) == cache.size
+    for slot in slots:
+        assert cache.index[cache._find(cache.keys[slot])] == slot
+
+
+def _colliding_keys(cache, n):
+    # Keys with the same home bucket.
+    keys = []
+    key = 0
+    while len(keys) < n:
+        if cache._home(key) == cache._home(0):
+            keys.append(key)
+        key += 1
+    return keys
+
+
+def test_array_delete_shifts_back():
+    cache = ArrayLRUCache(8)
+    keys = _colliding_keys(cache, 4)
+    for key in keys:
+        cache.put(key, key + 1)
+    cache.delete(keys[0])
+    _check_index(cache)
+    # The other keys moved back towards their home bucket.
+    assert cache.index[cache._home(keys[1])] != cache.EMPTY
+    for key in keys[1:]:
+        assert cache.get(key) == key + 1
+    assert cache.get(keys[0]) == -1
+    # The freed slot is reused.
+    cache.put(keys[0], 0)
+    assert len(cache) == 4
+    assert cache.get(keys[0]) == 0
+
+
+def test_array_evict_reuses_slot():
+    cache = ArrayLRUCache(2)
+    cache.put(1, 1)
+    cache.put(2, 2)
+    assert cache.get(1) == 1
+    cache.put(3, 3)
+    # 2 was the least recently used key and 3 took its slot.
+    assert cache.get(2) == -1
+    assert (cache.get(1), cache.get(3)) == (1, 3)
+    assert sorted(cache.keys) == [1, 3]
+    _check_index(cache)
+
+
+@pytest.mark.parametrize("capacity", [1, 2, 7, 64])
+def test_array_fuzz(capacity):
+    """Fuzz test.
+
+    Apply random gets, puts and deletes to an ArrayLRUCache and to an LRU
+    cache on top of collections.OrderedDict and check that they agree. The
+    keys come from a small range (so there are many hits, evictions and
+    deletes) and include negative and 64-bit keys.
+    """
+    random.seed(capacity)
+    cache = ArrayLRUCache(capacity)
+    reference = ReferenceLRUCache(capacity)
+    keys = list(range(-capacity, 2 * capacity)) + [2 ** 63 - 1, -2 ** 63, 2 ** 40]
+    for _ in range(20000):
+        key = random.choice(keys)
+        r = random.random()
+        if r < 0.4:
+            assert cache.get(key) == reference.get(key)
+        elif r < 0.8:
+            value = random.randint(-1000, 1000)
+            cache.put(key, value)
+            reference.put(key, value)
+        else:
+            cache.delete(key)
+            reference.delete(key)
+        assert len(cache) == len(reference.cache)
+    _check_index(cache)
+    # Same keys in the same order of use.
+    order = []
+    slot = cache.next[cache.dummy]
+    while slot != cache.dummy:
+        order.append((cache.keys[slot], cache.values[slot]))
+        slot = cache.next[slot]
+    assert order == list(reference.cache.items())
+
+
+@pytest.mark.parametrize("capacity, num_shards", [(1, 4), (10, 1), (10, 4), (100, 16)])
+def test_sharded_fuzz(capacity, num_shards):
+    """Fuzz test.
+
+    Same as test_array_fuzz for a ShardedLRUCache without deletes. Each
+    shard evicts its own least recently used key, so the reference has an
+    LRU cache per shard.
+    """
+    random.seed(capacity)
+    cache = ShardedLRUCache(capacity, num_shards)
+    assert sum(shard.capacity for shard in cache.shards) == capacity
+    references = [ReferenceLRUCache(shard.capacity) for shard in cache.shards]
+    keys = list(range(3 * capacity)) + ["a", "b", (1, 2)]
+    num_hits = 0
+    num_gets = 0
+    for _ in range(20000):
+        key = random.choice(keys)
+        reference = references[cache._shard(key)]
+        if random.random() < 0.5:
+            value = cache.get(key)
+            assert value == reference.get(key)
+            num_gets += 1
+            num_hits += value != -1
+        else:
+            value = random.randint(0, 1000)
+            cache.put(key, value)
+            reference.put(key, value)
+        assert len(cache) == sum(len(reference.cache) for reference in references)
+        assert len(cache) <= capacity
+    stats = cache.stats()
+    assert sum(shard_stats["hits"] for shard_stats in stats) == num_hits
+    assert sum(shard_stats["misses"] for shard_stats in stats) == num_gets - num_hits
+
+
+def test_sharded_threads():
+    capacity = 100
+    cache = ShardedLRUCache(capacity, num_shards=8)
+    wrong_values = []
+
+    def work(seed):
+        rng = random.Random(seed)
+        for _ in range(5000):
+            key = rng.randrange(300)
+            value = cache.get(key)
+            # Every thread puts the same value for a key.
+            if value not in (-1, key * 2):
+                wrong_values.append((key, value))
+            if value == -1:
+                cache.put(key, key * 2)
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wrong_values == []
+    assert len(cache) <= capacity
+    for shard in cache.shards:
+        # The linked list of every shard is intact.
+        assert len(list(shard.cache)) == len(shard.cache) <= shard.capacity
@@ -178,6 +178,16 @@ Footnotes:
 
 * We overlap the map and shuffle phase by splitting the REDUCE
   task into a REDUCE_READ and REDUCE_GROUP.
+* Each partition is owned by one worker (round-robin over the machines).
+  Every heartbeat response carries a "fetches" list with all the REDUCE_READ
+  tasks for the partitions owned by that worker whose map output is ready.
+  The worker hands them to a bounded pool of fetcher threads, which call
+  the `read_file` RPC of the worker that ran the map task, and goes on with
+  the task in the response. Finished fetches are reported on the next
+  heartbeat, so shuffle wall time approaches max(fetch) rather than
+  sum(fetch) and the fetches overlap with map work.
+* The fetchers only read and parse the map output. The main thread merges
+  the key-value pairs into the partition, so we don't need a lock.
 * Do we need a locking mechanism? No, because everything is going through the
   leader and the SimpleXMLRPCServer is single-threaded.
 * If we use extra memory instead of looping through all the tasks in the tasks dict,
@@ -187,6 +197,22 @@ Footnotes:
 * Check loops from yield vs return
 * It's a little tricky to start the leader before the worker if the leader is
   not in a separate process
+* Each worker reports per-task start/end timestamps, per-phase timings and
+  counters with the completed task IDs on the next heartbeat. The leader sums
+  the counters across tasks and, when the job ends, writes them to
+  `COUNTERS_FILE` and a Chrome trace (open it in chrome://tracing or
+  https://ui.perfetto.dev) to `TRACE_FILE`.
+* The built-in counters are in the "mapreduce" group. The combiner reduction
+  ratio is combine_output_records / combine_input_records.
+* A mapper, combiner or reducer can call `increment_counter(group, counter)`
+  (like mrjob's `increment_counter`). It works because each worker process
+  runs one task at a time.
+* XML-RPC ints are limited to 32 bits, so the counters are sent as doubles.
+* By default, the mapper is called once per line of a chunk. With
+  `raw_mapper=True`, it is called once per chunk with the bytes of the whole
+  chunk (like mrjob's `mapper_raw`), so it can process the chunk in bulk
+  instead of paying a call per line. A chunk then counts as one map input
+  record.
 
 
 # Sources
@@ -198,16 +224,25 @@ Footnotes:
 * https://stackoverflow.com/questions/30893970/reducer-starts-before-mapper-has-finished
 """
 import collections
+import concurrent.futures
+import contextlib
 import hashlib
+import json
 import jsonlines
 import multiprocessing
+import os
+import socketserver
+import threading
 import time
+import xmlrpc.client
 import xmlrpc.server
 
 BASE_DIR = "tmp"
 INTERMEDIATE_KV_TEMPLATE = "tmp/{task_id}-{partition}.jsonl"
 OUTPUT_SPLIT_TEMPLATE = "tmp/out_{partition}.jsonl"
 OUTPUT_FILE = "tmp/out.jsonl"
+COUNTERS_FILE = "tmp/counters.json"
+TRACE_FILE = "tmp/trace.json"
 
 MAP = "MAP"
 REDUCE_READ = "REDUCE_READ"
@@ -219,12 +254,57 @@ IDLE = "IDLE"
 IN_PROGRESS = "IN_PROGRESS"
 COMPLETED = "COMPLETED"
 
+COUNTER_GROUP = "mapreduce"
+
+LEADER_URI = "http://localhost:8000"
+NUM_FETCHERS = 4
+
+# Counters of the task that the worker process is currently running.
+_counters = None
+
+def increment_counter(group, counter, amount=1):
+	if _counters is None:
+		raise RuntimeError("increment_counter called outside of a task")
+	_counters[group][counter] += amount
+
 def _identity_combiner(key, values):
 	yield values
 
+def _worker_port(machine):
+	return 8001 + machine
+
+def _worker_uri(machine):
+	return f"http://localhost:{_worker_port(machine)}"
+
+def _read_file(path):
+	with open(path, 'rb') as fin:
+		return xmlrpc.client.Binary(fin.read())
+
+class _ThreadingXMLRPCServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+	# Serve the `read_file` calls of several fetchers at once.
+	daemon_threads = True
+
+def _trace_event(name, cat, start, end, pid, tid=0, args=None):
+	# Chrome trace "complete" event with timestamps in microseconds.
+	return {
+		"name": name,
+		"cat": cat,
+		"ph": "X",
+		"ts": start * 1e6,
+		"dur": (end - start) * 1e6,
+		"pid": pid,
+		"tid": tid,
+		"args": args or {}
+	}
+
 class Leader:
 
 	def __init__(self, chunks, num_reduce_partitions):
+		machines = sorted(set([c["machine"] for c in chunks]))
+		partition_to_machine = {}
+		for partition in range(num_reduce_partitions):
+			partition_to_machine[partition] = machines[partition % len(machines)]
+
 		self._task_id_to_task = {}
 		for chunk in chunks:
 			map_task_id = len(self._task_id_to_task)
@@ -244,7 +324,8 @@ class Leader:
 					"map_task_id": map_task_id,
 					"partition": partition,
 					"input_file": "",
-					"machine": -1
+					"uri": "",
+					"machine": partition_to_machine[partition]
 				}
 		for partition in range(num_reduce_partitions):
 			task_id = len(self._task_id_to_task)
@@ -253,21 +334,76 @@ class Leader:
 				"type": REDUCE_GROUP,
 				"status": IDLE,
 				"partition": partition,
-				"machine": -1
+				"machine": partition_to_machine[partition]
 			}
 
 		self._completed = False
-		self._num_workers = len(set([c["machine"] for c in chunks]))
+		self._num_workers = len(machines)
 		self._num_reduce_partitions = num_reduce_partitions
 
-	def heartbeat(self, machine, completed_tasks):
+		self._start_time = time.time()
+		self._task_id_to_scheduled_time = {}
+		self._job_counters = collections.defaultdict(collections.Counter)
+		# The leader is pid 0 and machine `m` is pid `m + 1`.
+		self._trace_events = [{
+			"name": "process_name",
+			"ph": "M",
+			"pid": 0,
+			"args": {"name": "leader"}
+		}]
+		for machine in machines:
+			self._trace_events.append({
+				"name": "process_name",
+				"ph": "M",
+				"pid": machine + 1,
+				"args": {"name": f"worker {machine}"}
+			})
+
+	def _record_task_report(self, report):
+		task_counters = {}
+		for group, counters in report["counters"].items():
+			for counter, value in counters.items():
+				self._job_counters[group][counter] += int(value)
+				task_counters[f"{group}.{counter}"] = int(value)
+
+		pid = report["machine"] + 1
+		scheduled = self._task_id_to_scheduled_time[report["id"]]
+		task_counters["scheduling_delay_ms"] = (report["start"] - scheduled) * 1e3
+		self._trace_events.append(_trace_event(
+			f"{report['type']} {report['id']}", report["type"],
+			report["start"], report["end"], pid, report["tid"], task_counters))
+		for phase in report["phases"]:
+			self._trace_events.append(_trace_event(
+				phase["name"], "phase", phase["start"], phase["end"], pid,
+				report["tid"]))
+
+	def heartbeat(self, machine, completed_tasks, task_reports=()):
+		start = time.time()
+		for report in task_reports:
+			self._record_task_report(report)
+		task = self._heartbeat(machine, completed_tasks)
+		if task["type"] not in (SLEEP, EXIT):
+			self._task_id_to_scheduled_time[task["id"]] = start
+		for fetch in task.get("fetches", []):
+			self._task_id_to_scheduled_time[fetch["id"]] = start
+		end = time.time()
+
+		self._job_counters[COUNTER_GROUP]["leader_heartbeats"] += 1
+		self._job_counters[COUNTER_GROUP]["leader_heartbeat_us"] += \
+			int((end - start) * 1e6)
+		self._trace_events.append(_trace_event(
+			"heartbeat", "leader", start, end, 0, 0,
+			{"machine": machine, "response": task["type"]}))
+		return task
+
+	def _heartbeat(self, machine, completed_tasks):
 		for task_id in completed_tasks:
 			task = self._task_id_to_task[task_id]
 			task["status"] = COMPLETED
 			if task["type"] != MAP:
 				continue
 			# Update all the partitions for that map task with the path
-			# to the intermediate KV file.
+			# to the intermediate KV file and the worker that serves it.
 			for partition in range(self._num_reduce_partitions):
 				for t in self._task_id_to_task.values():
 					if t["type"] == REDUCE_READ and \
@@ -277,6 +413,7 @@ class Leader:
 						input_file = INTERMEDIATE_KV_TEMPLATE.format(
 							task_id=task["id"], partition=partition)
 						t["input_file"] = input_file
+						t["uri"] = _worker_uri(machine)
 
 		all_tasks_completed = True
 		for task in self._task_id_to_task.values():
@@ -303,9 +440,24 @@ class Leader:
 			if task["type"] == REDUCE_READ and task["status"] != COMPLETED:
 				partition_to_reduce_reads_completed[task["partition"]] = False
 
+		# Hand out every map output that is ready for the partitions
+		# owned by the machine, so that the worker can fetch them concurrently.
+		fetches = []
 		for task in self._task_id_to_task.values():
 			if task["status"] != IDLE:
 				continue
+			if task["type"] != REDUCE_READ or task["machine"] != machine:
+				continue
+			if not task["input_file"]:
+				continue
+			task["status"] = IN_PROGRESS
+			fetches.append(task)
+
+		for task in self._task_id_to_task.values():
+			if task["status"] != IDLE:
+				continue
+			if task["type"] == REDUCE_READ:
+				continue
 			if task["type"] == MAP and task["chunk"]["machine"] != machine:
 				continue
 			if task["type"] == REDUCE_GROUP and \
@@ -313,107 +465,220 @@ class Leader:
 				continue
 			if task["type"] == REDUCE_GROUP and task["machine"] != machine:
 				continue
-			if task["type"] == REDUCE_READ and (not task["input_file"]):
-				continue
-
-			if task["type"] == REDUCE_READ and task["machine"] == -1:
-				# Now that this reduce task is getting a machine,
-				# we have to assign the same machine to
-				# all the other reduce tasks in the partition.
-				task["machine"] = machine
-				for t in self._task_id_to_task.values():
-					if t["id"] == task["id"]:
-						continue
-					if t["type"] in (REDUCE_READ, REDUCE_GROUP) and t["partition"] == task["partition"]:
-						assert t["machine"] == -1
-						t["machine"] = machine
-			elif task["type"] == REDUCE_READ and task["machine"] != machine:
-				continue
 
 			task["status"] = IN_PROGRESS
-			return task
+			return dict(task, fetches=fetches)
+
+		return {"type": SLEEP, "fetches": fetches}
+
+	def _write_counters_and_trace(self):
+		job_counters = {
+			group: dict(counters) for group, counters in self._job_counters.items()
+		}
+		builtin = job_counters.setdefault(COUNTER_GROUP, {})
+		builtin["job_us"] = int((time.time() - self._start_time) * 1e6)
+		if builtin.get("combine_input_records"):
+			builtin["combine_reduction_ratio"] = \
+				builtin["combine_output_records"] / builtin["combine_input_records"]
 
-		return {"type": SLEEP}
+		with open(COUNTERS_FILE, 'w') as fout:
+			json.dump(job_counters, fout, indent=2, sort_keys=True)
+		with open(TRACE_FILE, 'w') as fout:
+			json.dump({"traceEvents": self._trace_events}, fout)
 
 	def run(self):
 		server = xmlrpc.server.SimpleXMLRPCServer(("localhost", 8000), logRequests=False)
 		server.register_function(self.heartbeat)
 		while not self._completed:
 			server.handle_request()
+		self._write_counters_and_trace()
 
 class Worker:
 
-	def __init__(self, machine, mapper, reducer, combiner):
+	def __init__(self, machine, mapper, reducer, combiner, num_fetchers=NUM_FETCHERS,
+			raw_mapper=False):
 		self._machine = machine
 		self._mapper = mapper
+		self._raw_mapper = raw_mapper
 		self._reducer = reducer
+		self._num_fetchers = num_fetchers
 		if combiner:
 			self._combiner = combiner
 		else:
 			self._combiner = _identity_combiner
 
+	def _begin_task(self, task):
+		global _counters
+		_counters = collections.defaultdict(collections.Counter)
+		return {
+			"id": task["id"],
+			"type": task["type"],
+			"machine": self._machine,
+			"tid": 0,
+			"start": time.time(),
+			"phases": []
+		}
+
+	@contextlib.contextmanager
+	def _phase(self, report, name):
+		start = time.time()
+		yield
+		report["phases"].append(
+			{"name": name, "start": start, "end": time.time()})
+
+	def _end_task(self, report):
+		global _counters
+		report["end"] = time.time()
+		report["counters"] = {}
+		for group, counters in _counters.items():
+			report["counters"][group] = {
+				counter: float(value) for counter, value in counters.items()
+			}
+		_counters = None
+		return report
+
+	def _fetch(self, task):
+		# Runs on a fetcher thread, so it reports its own counters
+		# instead of using the module-level `_counters`.
+		start = time.time()
+		with xmlrpc.client.ServerProxy(task["uri"]) as proxy:
+			data = proxy.read_file(task["input_file"]).data
+		kvs = [json.loads(line) for line in data.splitlines()]
+		end = time.time()
+
+		# Fetcher threads are named "fetcher_0", "fetcher_1", etc.
+		fetcher = int(threading.current_thread().name.rsplit("_", 1)[1])
+		report = {
+			"id": task["id"],
+			"type": task["type"],
+			"machine": self._machine,
+			"tid": fetcher + 1,
+			"start": start,
+			"end": end,
+			"phases": [],
+			"counters": {
+				COUNTER_GROUP: {
+					"shuffle_bytes": float(len(data)),
+					"shuffle_records": float(len(kvs))
+				}
+			}
+		}
+		return task, kvs, report
+
 	def run(self):
+		server = _ThreadingXMLRPCServer(
+			("localhost", _worker_port(self._machine)), logRequests=False)
+		server.register_function(_read_file, "read_file")
+		server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+		server_thread.start()
+
+		fetcher_pool = concurrent.futures.ThreadPoolExecutor(
+			max_workers=self._num_fetchers, thread_name_prefix="fetcher")
+		fetch_futures = set()
+
 		partition_to_key_to_values = {}
 		completed_tasks = []
+		task_reports = []
 		while True:
-			with xmlrpc.client.ServerProxy("http://localhost:8000") as proxy:
-				task = proxy.heartbeat(self._machine, completed_tasks)
+			with xmlrpc.client.ServerProxy(LEADER_URI) as proxy:
+				task = proxy.heartbeat(self._machine, completed_tasks, task_reports)
 			completed_tasks = []
+			task_reports = []
 			print(task)
 			if task["type"] == EXIT:
+				assert not fetch_futures
 				break
-			elif task["type"] == SLEEP:
-				time.sleep(2)
+
+			for fetch in task["fetches"]:
+				fetch_futures.add(fetcher_pool.submit(self._fetch, fetch))
+
+			if task["type"] == SLEEP:
+				if fetch_futures:
+					concurrent.futures.wait(
+						fetch_futures, timeout=2,
+						return_when=concurrent.futures.FIRST_COMPLETED)
+				else:
+					time.sleep(2)
 			elif task["type"] == MAP:
 				assert task["chunk"]["machine"] == self._machine
+				report = self._begin_task(task)
+				counters = _counters[COUNTER_GROUP]
+
+				with self._phase(report, "map"):
+					path = task["chunk"]["path"]
+					counters["map_input_bytes"] += os.path.getsize(path)
+					key_to_values = collections.defaultdict(list)
+					with open(path, 'rb' if self._raw_mapper else 'r') as fin:
+						records = [fin.read()] if self._raw_mapper else fin
+						for record in records:
+							counters["map_input_records"] += 1
+							for key, value in self._mapper(path, record):
+								counters["map_output_records"] += 1
+								key_to_values[key].append(value)
+
+				with self._phase(report, "combine"):
+					# Write out a file even if it's empty.
+					partition_to_intermediate_kvs = {}
+					for partition in range(task["num_reduce_partitions"]):
+						partition_to_intermediate_kvs[partition] = []
+
+					for key, values in key_to_values.items():
+						counters["combine_input_records"] += len(values)
+						for new_values in self._combiner(key, values):
+							h = int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
+							partition = h % task["num_reduce_partitions"]
+							for new_value in new_values:
+								counters["combine_output_records"] += 1
+								partition_to_intermediate_kvs[partition].append(
+									[key, new_value])
 
-				key_to_values = collections.defaultdict(list)
-				with open(task["chunk"]["path"], 'r') as fin:
-					for line in fin:
-						for key, value in self._mapper(task["chunk"]["path"], line):
-							key_to_values[key].append(value)
-
-				# Write out a file even if it's empty.
-				partition_to_intermediate_kvs = {}
-				for partition in range(task["num_reduce_partitions"]):
-					partition_to_intermediate_kvs[partition] = []
-
-				for key, values in key_to_values.items():
-					for new_values in self._combiner(key, values):
-						h = int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
-						partition = h % task["num_reduce_partitions"]
-						for new_value in new_values:
-							partition_to_intermediate_kvs[partition].append(
-								[key, new_value])
-
-				for partition, intermediate_kvs in partition_to_intermediate_kvs.items():
-					path = INTERMEDIATE_KV_TEMPLATE.format(
-						task_id=task["id"], partition=partition)
-					with jsonlines.open(path, 'w') as fout:
-						for kv in intermediate_kvs:
-							fout.write(kv)
-
-				completed_tasks.append(task["id"])
-			elif task["type"] == REDUCE_READ:
-				if task["partition"] not in partition_to_key_to_values:
-					partition_to_key_to_values[task["partition"]] = collections.defaultdict(list)
-				# Simulate RPC.
-				with jsonlines.open(task["input_file"], 'r') as fin:
-					for key, value in fin:
-						partition_to_key_to_values[task["partition"]][key].append(value)
+				with self._phase(report, "spill"):
+					for partition, intermediate_kvs in partition_to_intermediate_kvs.items():
+						path = INTERMEDIATE_KV_TEMPLATE.format(
+							task_id=task["id"], partition=partition)
+						with jsonlines.open(path, 'w') as fout:
+							for kv in intermediate_kvs:
+								fout.write(kv)
+						counters["spilled_records"] += len(intermediate_kvs)
+						counters["spilled_bytes"] += os.path.getsize(path)
 
 				completed_tasks.append(task["id"])
+				task_reports.append(self._end_task(report))
 			elif task["type"] == REDUCE_GROUP:
+				report = self._begin_task(task)
+				counters = _counters[COUNTER_GROUP]
 				path = OUTPUT_SPLIT_TEMPLATE.format(partition=task["partition"])
-				with jsonlines.open(path, 'w') as fout:
-					for key, values in partition_to_key_to_values[task["partition"]].items():
-						for new_values in self._reducer(key, values):
-							for new_value in new_values:
-								fout.write([key, new_value])
+				with self._phase(report, "reduce"):
+					with jsonlines.open(path, 'w') as fout:
+						for key, values in partition_to_key_to_values[task["partition"]].items():
+							counters["reduce_input_groups"] += 1
+							counters["reduce_input_records"] += len(values)
+							for new_values in self._reducer(key, values):
+								for new_value in new_values:
+									counters["reduce_output_records"] += 1
+									fout.write([key, new_value])
+					counters["output_bytes"] += os.path.getsize(path)
 
 				completed_tasks.append(task["id"])
-
-def mapreduce(chunks, mapper, reducer, num_reduce_partitions, combiner=None):
+				task_reports.append(self._end_task(report))
+
+			# Merge the finished fetches and report them on the next heartbeat.
+			for future in [f for f in fetch_futures if f.done()]:
+				fetch_futures.remove(future)
+				fetch, kvs, report = future.result()
+				if fetch["partition"] not in partition_to_key_to_values:
+					partition_to_key_to_values[fetch["partition"]] = collections.defaultdict(list)
+				key_to_values = partition_to_key_to_values[fetch["partition"]]
+				for key, value in kvs:
+					key_to_values[key].append(value)
+				completed_tasks.append(fetch["id"])
+				task_reports.append(report)
+
+		fetcher_pool.shutdown()
+		server.shutdown()
+
+def mapreduce(chunks, mapper, reducer, num_reduce_partitions, combiner=None,
+		num_fetchers=NUM_FETCHERS, raw_mapper=False):
 	leader = Leader(chunks, num_reduce_partitions)
 	leader_process = multiprocessing.Process(target=leader.run)
 	leader_process.start()
@@ -422,7 +687,7 @@ def mapreduce(chunks, mapper, reducer, num_reduce_partitions, combiner=None):
 	worker_machines = set([c["machine"] for c in chunks])
 	worker_processes = []
 	for machine in worker_machines:
-		worker = Worker(machine, mapper, reducer, combiner)
+		worker = Worker(machine, mapper, reducer, combiner, num_fetchers, raw_mapper)
 		p = multiprocessing.Process(target=worker.run)
 		p.start()
 		worker_processes.append(p)
@@ -443,3 +708,6 @@ def mapreduce(chunks, mapper, reducer, num_reduce_partitions, combiner=None):
 	with jsonlines.open(OUTPUT_FILE, 'w') as fout:
 		for kv in output_kvs:
 			fout.write(kv)
+
+	with open(COUNTERS_FILE, 'r') as fin:
+		return json.load(fin)
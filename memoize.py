@@ -0,0 +1,421 @@
+"""
+Memoizing decorator on top of LRUCache with TTL, stale-while-revalidate and single-flight.
+
+Notes:
+* memoize caches the results of a function by its arguments in an LRUCache (lru_cache.py), so
+  the cache is bounded by capacity (the number of results) and optionally by max_weight with a
+  weigher(key, value).
+* TTL: an entry is fresh for ttl seconds after it was loaded. After that, it is a miss and
+  the next call loads it again. ttl=None means that entries never expire.
+* Stale-while-revalidate: for stale_ttl seconds after an entry expires, a call returns the
+  stale value right away and refreshes the entry in the background (a thread for a sync
+  function, a task for an async function). So a hot key never makes a caller wait for a load.
+* Single-flight: when many threads miss on the same key at the same time (e.g., after a cold
+  start), only the first one calls the function. It registers an in-flight future for the key
+  and the others wait for that future instead of calling the function again. A background
+  refresh also registers its future, so a key is refreshed at most once at a time.
+  * Sync functions use concurrent.futures.Future and a lock around the cache and the
+    in-flight futures. The lock is not held while the function runs.
+  * Async functions use an asyncio.Task. All coroutines of an event loop run on one thread and
+    there is no await between the lookup and the registration of the task, so they don't need
+    a lock. The waiters await asyncio.shield(task), so that a cancelled waiter doesn't cancel
+    the load for the others.
+  * If the function raises, every waiter gets the exception and nothing is cached.
+* The decorated function has cache_info() (hits, misses, stale hits, loads, load failures,
+  total load time, evictions, size) and cache_clear(), like functools.lru_cache.
+
+Run tests:
+
+pytest memoize.py
+
+Usage:
+@memoize(capacity=1024, ttl=60, stale_ttl=30)
+def get_user(user_id):
+    ...
+
+@memoize(capacity=1024, ttl=60)
+async def get_user_async(user_id):
+    ...
+
+Sources:
+* https://docs.python.org/3/library/functools.html#functools.lru_cache
+* https://web.dev/articles/stale-while-revalidate
+* https://pkg.go.dev/golang.org/x/sync/singleflight
+"""
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import threading
+import time
+
+from lru_cache import LRUCache
+
+FRESH = "fresh"
+STALE = "stale"
+MISS = "miss"
+
+# Separates the positional arguments from the keyword arguments in a key, like
+# functools._make_key. It is not equal to any argument, so f(1, a=1) and
+# f(1, <marker>, ("a", 1)) can't get the same key.
+_KWD_MARK = (object(),)
+
+class Entry:
+
+    def __init__(self, value, expires_at, stale_until):
+        self.value = value
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class Memoizer:
+
+    def __init__(self, capacity=128, ttl=None, stale_ttl=None, max_weight=None, weigher=None,
+                 clock=time.monotonic):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        entry_weigher = None
+        if weigher is not None:
+            entry_weigher = lambda key, entry: weigher(key, entry.value)
+        self.cache = LRUCache(capacity, max_weight=max_weight, weigher=entry_weigher)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.num_loads = 0
+        self.num_load_failures = 0
+        self.load_time = 0.0
+
+    @staticmethod
+    def make_key(args, kwargs):
+        if not kwargs:
+            return args
+        return args + _KWD_MARK + tuple(sorted(kwargs.items()))
+
+    def lookup(self, key):
+        entry = self.cache.get(key)
+        now = self.clock()
+        if entry == -1:
+            self.misses += 1
+            return MISS, None
+        if (entry.expires_at is None) or (now < entry.expires_at):
+            self.hits += 1
+            return FRESH, entry
+        if (entry.stale_until is not None) and (now < entry.stale_until):
+            self.stale_hits += 1
+            return STALE, entry
+        self.misses += 1
+        return MISS, None
+
+    def finish_load(self, key, value, load_time, failed):
+        self.in_flight.pop(key, None)
+        self.num_loads += 1
+        self.load_time += load_time
+        if failed:
+            self.num_load_failures += 1
+            return
+        now = self.clock()
+        expires_at = None if self.ttl is None else now + self.ttl
+        stale_until = None
+        if (expires_at is not None) and (self.stale_ttl is not None):
+            stale_until = expires_at + self.stale_ttl
+        self.cache.put(key, Entry(value, expires_at, stale_until))
+
+    def cache_info(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "loads": self.num_loads,
+                "load_failures": self.num_load_failures,
+                "load_time": self.load_time,
+                "evictions": self.cache.num_evictions,
+                "size": len(self.cache.cache),
+            }
+
+    def cache_clear(self):
+        with self.lock:
+            self.cache = LRUCache(
+                self.cache.capacity, max_weight=self.cache.max_weight,
+                weigher=self.cache.weigher)
+
+
+def _memoize_sync(func, memoizer):
+
+    def load(key, args, kwargs, future):
+        start = time.perf_counter()
+        try:
+            value = func(*args, **kwargs)
+        except BaseException as e:
+            with memoizer.lock:
+                memoizer.finish_load(key, None, time.perf_counter() - start, failed=True)
+            future.set_exception(e)
+            return
+        with memoizer.lock:
+            memoizer.finish_load(key, value, time.perf_counter() - start, failed=False)
+        future.set_result(value)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = memoizer.make_key(args, kwargs)
+        with memoizer.lock:
+            state, entry = memoizer.lookup(key)
+            if state == FRESH:
+                return entry.value
+            future = memoizer.in_flight.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = concurrent.futures.Future()
+                memoizer.in_flight[key] = future
+        if state == STALE:
+            if is_loader:
+                threading.Thread(
+                    target=load, args=(key, args, kwargs, future), daemon=True).start()
+            return entry.value
+        if is_loader:
+            load(key, args, kwargs, future)
+        return future.result()
+
+    return wrapper
+
+
+def _memoize_async(func, memoizer):
+
+    async def load(key, args, kwargs):
+        start = time.perf_counter()
+        try:
+            value = await func(*args, **kwargs)
+        except BaseException:
+            with memoizer.lock:
+                memoizer.finish_load(key, None, time.perf_counter() - start, failed=True)
+            raise
+        with memoizer.lock:
+            memoizer.finish_load(key, value, time.perf_counter() - start, failed=False)
+        return value
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = memoizer.make_key(args, kwargs)
+        with memoizer.lock:
+            state, entry = memoizer.lookup(key)
+            if state == FRESH:
+                return entry.value
+            task = memoizer.in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(load(key, args, kwargs))
+                memoizer.in_flight[key] = task
+        if state == STALE:
+            # Nobody awaits a background refresh, so retrieve its exception to avoid the
+            # "exception was never retrieved" warning.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return entry.value
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+def memoize(capacity=128, ttl=None, stale_ttl=None, max_weight=None, weigher=None,
+            clock=time.monotonic):
+
+    def decorator(func):
+        memoizer = Memoizer(capacity, ttl, stale_ttl, max_weight, weigher, clock)
+        if inspect.iscoroutinefunction(func):
+            wrapper = _memoize_async(func, memoizer)
+        else:
+            wrapper = _memoize_sync(func, memoizer)
+        wrapper.cache_info = memoizer.cache_info
+        wrapper.cache_clear = memoizer.cache_clear
+        return wrapper
+
+    return decorator
+
+
+########
+# Tests
+########
+
+
+import pytest
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_make_key():
+    assert Memoizer.make_key((1, 2), {}) == (1, 2)
+    # Keyword arguments don't depend on their order.
+    assert Memoizer.make_key((1,), {"a": 1, "b": 2}) == Memoizer.make_key((1,), {"b": 2, "a": 1})
+    # Positional arguments that look like the keyword arguments get a different key.
+    assert Memoizer.make_key((1, None, ("a", 1)), {}) != Memoizer.make_key((1,), {"a": 1})
+    assert Memoizer.make_key((1, ("a", 1)), {}) != Memoizer.make_key((1,), {"a": 1})
+
+    calls = []
+
+    @memoize()
+    def f(*args, **kwargs):
+        calls.append((args, kwargs))
+        return len(calls)
+
+    assert f(1, a=1) == 1
+    assert f(1, None, ("a", 1)) == 2
+    assert f(1, a=1) == 1
+
+
+def test_ttl():
+    clock = FakeClock()
+    calls = []
+
+    @memoize(ttl=10, clock=clock)
+    def f(x):
+        calls.append(x)
+        return x * len(calls)
+
+    assert f(2) == 2
+    clock.now = 9.9
+    assert f(2) == 2
+    # The entry expired, so it is loaded again.
+    clock.now = 10
+    assert f(2) == 4
+    assert calls == [2, 2]
+    info = f.cache_info()
+    assert (info["hits"], info["misses"], info["loads"]) == (1, 2, 2)
+
+
+def test_stale_while_revalidate():
+    clock = FakeClock()
+    load = threading.Event()
+    loaded = threading.Event()
+    calls = []
+
+    @memoize(ttl=10, stale_ttl=5, clock=clock)
+    def f(x):
+        calls.append(x)
+        if len(calls) > 1:
+            # Block the background refresh until the test lets it go.
+            load.wait()
+        loaded.set()
+        return len(calls)
+
+    assert f(1) == 1
+    loaded.clear()
+    # Stale: the stale value is returned right away and the entry is refreshed
+    # in the background, only once.
+    clock.now = 12
+    assert f(1) == 1
+    assert f(1) == 1
+    load.set()
+    assert loaded.wait(timeout=5)
+    for _ in range(100):
+        if f.cache_info()["loads"] == 2:
+            break
+        time.sleep(0.01)
+    assert f(1) == 2
+    assert calls == [1, 1]
+    assert f.cache_info()["stale_hits"] == 2
+    # Past the stale window, a call waits for a new load.
+    clock.now = 30
+    assert f(1) == 3
+
+
+def test_single_flight():
+    num_threads = 10
+    barrier = threading.Barrier(num_threads)
+    calls = []
+
+    @memoize()
+    def f(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return x * 2
+
+    results = []
+
+    def call():
+        barrier.wait()
+        results.append(f(3))
+
+    threads = [threading.Thread(target=call) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [6] * num_threads
+    assert calls == [3]
+    assert f.cache_info()["loads"] == 1
+
+
+def test_exception():
+    num_threads = 5
+    barrier = threading.Barrier(num_threads)
+    calls = []
+
+    @memoize()
+    def f(x):
+        calls.append(x)
+        time.sleep(0.1)
+        raise ValueError(x)
+
+    errors = []
+
+    def call():
+        barrier.wait()
+        try:
+            f(1)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every waiter gets the exception of the single load.
+    assert len(errors) == num_threads
+    assert calls == [1]
+    info = f.cache_info()
+    assert (info["loads"], info["load_failures"], info["size"]) == (1, 1, 0)
+    # Nothing was cached, so the next call loads again.
+    with pytest.raises(ValueError):
+        f(1)
+    assert calls == [1, 1]
+
+
+def test_async():
+    clock = FakeClock()
+    calls = []
+
+    @memoize(ttl=10, stale_ttl=5, clock=clock)
+    async def f(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError(x)
+        return x + len(calls)
+
+    async def main():
+        # Single-flight.
+        assert await asyncio.gather(*[f(1) for _ in range(20)]) == [2] * 20
+        assert calls == [1]
+        assert await f(1) == 2
+        # Stale-while-revalidate.
+        clock.now = 12
+        assert await f(1) == 2
+        await asyncio.sleep(0.05)
+        assert await f(1) == 3
+        assert calls == [1, 1]
+        # Exceptions reach every waiter.
+        results = await asyncio.gather(*[f(-1) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert calls == [1, 1, -1]
+
+    asyncio.run(main())
+    assert f.cache_info()["load_failures"] == 1
@@ -0,0 +1,207 @@
+"""Arena of real bytes on top of the memory managers.
+
+The memory managers (memory_manager.py, buddy_memory_manager.py, etc.)
+only hand out integer offsets into an imaginary range of addresses. A
+MemoryArena owns `capacity` bytes of real memory, either a bytearray or an
+anonymous mmap, and uses a memory manager to decide where each allocation
+goes.
+
+The malloc method asks the memory manager for `size` bytes. If the
+memory manager returns a start offset, then it returns a memoryview of the
+bytes [start, start + size) of the arena. A slice of a memoryview doesn't
+copy the bytes, so the caller reads and writes the memory of the arena
+directly (e.g., with `sock.recv_into(view)` or `struct.pack_into`).
+Otherwise, it returns None. A size that is not positive raises a ValueError
+before it reaches the memory manager, because some memory managers would
+hand out a start offset for it that they also hand out to the next
+allocation.
+
+The free method takes a memoryview that malloc returned, gives its start
+offset back to the memory manager and releases the memoryview, so any
+later use of it raises a ValueError instead of silently reading or writing
+memory that may belong to another allocation. It returns False for a
+memoryview that did not come from malloc or that was already freed.
+
+Notes:
+* The allocation policy is pluggable: `policy` is any class that takes the
+  capacity and has `malloc(size)`, which returns a start offset or -1, and
+  `free(start)`, which returns True or False. For example, MemoryManager
+  (first fit), LinkedListMemoryManager, BestFitMemoryManager,
+  SegregatedMemoryManager, BuddyMemoryManager or FreeListBuddyMemoryManager
+  (the buddy allocators need a capacity that is a power of 2).
+* We can't get the start offset of a memoryview slice back from the
+  memoryview, so we keep a map from `id(view)` to the start offset and the
+  view. The map holds a reference to the view, so its id can't be reused
+  by another object until it is freed.
+* Releasing a memoryview only invalidates that memoryview object. Objects
+  that were created from it (e.g., `memoryview(view)`, `view.cast("I")` or
+  a NumPy array from `np.frombuffer(view)`) export the buffer of the arena
+  itself, so they keep working after free and must not be used anymore.
+  While such an object exists, closing an mmap arena fails with a
+  BufferError.
+* The memory is not zeroed by malloc or free.
+* An anonymous mmap is not part of the Python heap: the OS maps its pages
+  lazily on first touch, so a large arena only uses the memory that is
+  written to.
+
+Run tests:
+
+pytest memory_arena.py
+
+See also:
+* memory_manager.py
+* memory_mapping.md
+
+Sources:
+* https://docs.python.org/3/library/stdtypes.html#memoryview
+* https://docs.python.org/3/library/mmap.html
+"""
+import mmap
+
+from memory_manager import MemoryManager
+
+
+class MemoryArena:
+
+	def __init__(self, capacity, policy=MemoryManager, use_mmap=False):
+		self.capacity = capacity
+		self.memory_manager = policy(capacity)
+		if use_mmap:
+			self._buffer = mmap.mmap(-1, capacity)
+		else:
+			self._buffer = bytearray(capacity)
+		self._memory = memoryview(self._buffer)
+		# Map from id(view) to (start, view) for each view that we handed out.
+		self._views = {}
+		self.used = 0
+
+	def malloc(self, size):
+		if size <= 0:
+			raise ValueError(f"size must be positive, got {size}")
+		start = self.memory_manager.malloc(size)
+		if start == -1:
+			return None
+		view = self._memory[start:start + size]
+		self._views[id(view)] = (start, view)
+		self.used += size
+		return view
+
+	def free(self, view):
+		entry = self._views.get(id(view))
+		if (entry is None) or (entry[1] is not view):
+			return False
+		start, _ = entry
+		size = len(view)
+		view.release()
+		del self._views[id(view)]
+		freed = self.memory_manager.free(start)
+		assert freed
+		self.used -= size
+		return True
+
+	def close(self):
+		for _, view in self._views.values():
+			view.release()
+		self._views.clear()
+		self._memory.release()
+		if isinstance(self._buffer, mmap.mmap):
+			self._buffer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+########
+# Tests
+########
+
+
+import pytest
+
+from best_fit_memory_manager import BestFitMemoryManager
+from buddy_memory_manager import BuddyMemoryManager
+from free_list_buddy_memory_manager import FreeListBuddyMemoryManager
+from linked_list_memory_manager import LinkedListMemoryManager
+from segregated_memory_manager import SegregatedMemoryManager
+
+
+@pytest.fixture(params=[False, True], ids=["bytearray", "mmap"])
+def arena(request):
+	with MemoryArena(1024, use_mmap=request.param) as arena:
+		yield arena
+
+
+def test_malloc_ok(arena):
+	view = arena.malloc(100)
+	assert len(view) == 100
+	assert arena.used == 100
+	# The view writes into the arena without a copy.
+	view[:5] = b"hello"
+	assert bytes(arena._buffer[:5]) == b"hello"
+
+
+def test_malloc_fail(arena):
+	assert arena.malloc(10000) is None
+	assert arena.used == 0
+
+
+def test_malloc_invalid_size(arena):
+	for size in [0, -1]:
+		with pytest.raises(ValueError):
+			arena.malloc(size)
+	# The memory manager is untouched.
+	view = arena.malloc(100)
+	assert arena.free(view)
+	assert arena.memory_manager.free_list == [[0, 1024]]
+
+
+def test_free_ok(arena):
+	view0 = arena.malloc(100)
+	view1 = arena.malloc(100)
+	assert arena.free(view0)
+	assert arena.used == 100
+	# The space of view0 is reused.
+	view2 = arena.malloc(100)
+	view2[:] = bytes(range(100))
+	assert bytes(arena._buffer[:100]) == bytes(range(100))
+
+
+def test_free_fail(arena):
+	view = arena.malloc(100)
+	# Not from malloc.
+	assert not arena.free(view[:10])
+	assert not arena.free(memoryview(bytearray(100)))
+	assert arena.free(view)
+	# Double free.
+	assert not arena.free(view)
+
+
+def test_use_after_free(arena):
+	view = arena.malloc(100)
+	assert arena.free(view)
+	with pytest.raises(ValueError):
+		view[0] = 1
+
+
+@pytest.mark.parametrize("policy", [
+	MemoryManager,
+	LinkedListMemoryManager,
+	BestFitMemoryManager,
+	SegregatedMemoryManager,
+	BuddyMemoryManager,
+	FreeListBuddyMemoryManager,
+])
+def test_policy(policy):
+	with MemoryArena(1024, policy=policy) as arena:
+		views = [arena.malloc(100) for _ in range(8)]
+		for i, view in enumerate(views):
+			view[:] = bytes([i]) * 100
+		# The views don't overlap.
+		for i, view in enumerate(views):
+			assert bytes(view) == bytes([i]) * 100
+		for view in views:
+			assert arena.free(view)
+		assert arena.used == 0
+		assert len(arena.malloc(1024)) == 1024
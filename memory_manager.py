@@ -34,6 +34,8 @@ pytest memory_manager.py
 See also:
 * linked_list_memory_manager.py
 * buddy_memory_manager.py
+* segregated_memory_manager.py
+* best_fit_memory_manager.py
 * ostep_free_space_management.md
 
 Sources:
@@ -0,0 +1,249 @@
+"""Replay malloc/free traces against the memory managers.
+
+A trace is a list of operations: ("malloc", id, size) reserves `size`
+units for the allocation `id` and ("free", id) frees it. We replay the same
+trace against every memory manager with the same capacity. If a malloc
+fails, then the allocation counts as a failure and we skip its free.
+
+For each memory manager, we report:
+* ops/s: malloc and free calls per second (the time of the calls only).
+* failures: the fraction of mallocs that return -1.
+* peak extent: the largest end address of a reservation, i.e., how much of
+  the arena the memory manager had to touch.
+* external fragmentation: 1 - (largest free block) / (total free space),
+  i.e., how much of the free space can't serve a request as large as the
+  free space. 0 means that all the free space is in one block.
+* internal fragmentation: 1 - (requested space) / (reserved space), i.e.,
+  how much of the reserved space is padding. Only the buddy and slab
+  allocators round up requests.
+
+We sample both kinds of fragmentation every `sample_every` operations and
+report the mean over the samples. `replay` also returns the samples, so we
+can plot them over time. With `--samples_dir`, we write the samples of each
+memory manager to a CSV file with the columns op, external and internal.
+
+Synthetic traces draw the size of each allocation from a distribution
+and its lifetime (in number of mallocs) from an exponential distribution,
+so about `mean_lifetime` allocations are live at a time:
+* uniform: uniform sizes in [1, 4096].
+* exponential: many small sizes and a few large ones (mean 256).
+* bimodal: 90% small sizes in [16, 128] and 10% large sizes in [4096, 32768].
+* power_of_2: powers of 2 in [16, 4096], the best case for buddy allocators.
+* fixed: a handful of object sizes, the best case for slab allocators.
+
+A recorded trace is a text file with a line per operation: "malloc id size"
+or "free id" (write_trace writes a trace in that format).
+
+Usage:
+
+python memory_manager_benchmark.py [trace_file] [--samples_dir samples_dir]
+
+Without a trace file, it replays a trace of each synthetic distribution.
+The samples of a trace file go to samples_dir/<memory manager>.csv and the
+samples of a distribution go to samples_dir/<distribution>_<memory manager>.csv.
+
+Notes:
+* The capacity is a power of 2 for the buddy allocators.
+* The slab allocator caches the object sizes of the Linux kmalloc caches
+  up to 512 and sends larger requests to its buddy allocator.
+* The largest free block of BuddyMemoryManager is the root of its tree.
+  For SlabMemoryManager, we count the free slots of the slabs as free space
+  and the largest free block of its buddy allocator as the largest free
+  block, so the free slots count as fragmentation.
+* Computing the fragmentation walks the free list, so we only do it for
+  the samples and outside of the timed calls.
+
+See also:
+* memory_manager.py
+* linked_list_memory_manager.py
+* buddy_memory_manager.py
+* best_fit_memory_manager.py
+* segregated_memory_manager.py
+* free_list_buddy_memory_manager.py
+* slab_memory_manager.py
+"""
+import argparse
+import csv
+import functools
+import heapq
+import os
+import random
+import time
+
+from best_fit_memory_manager import BestFitMemoryManager
+from buddy_memory_manager import BuddyMemoryManager
+from free_list_buddy_memory_manager import FreeListBuddyMemoryManager
+from linked_list_memory_manager import LinkedListMemoryManager
+from memory_manager import MemoryManager
+from segregated_memory_manager import SegregatedMemoryManager
+from slab_memory_manager import SlabMemoryManager
+
+CAPACITY = 1 << 20
+NUM_MALLOCS = 20000
+MEAN_LIFETIME = 400
+SAMPLE_EVERY = 500
+
+MEMORY_MANAGERS = {
+	"first_fit": MemoryManager,
+	"linked_list": LinkedListMemoryManager,
+	"best_fit": BestFitMemoryManager,
+	"segregated": SegregatedMemoryManager,
+	"buddy": BuddyMemoryManager,
+	"free_list_buddy": FreeListBuddyMemoryManager,
+	"slab": functools.partial(
+		SlabMemoryManager,
+		object_sizes=[16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512],
+		slab_size=4096),
+}
+
+SIZE_DISTRIBUTIONS = {
+	"uniform": lambda rng: rng.randint(1, 4096),
+	"exponential": lambda rng: max(1, int(rng.expovariate(1 / 256))),
+	"bimodal": lambda rng: rng.randint(16, 128) if rng.random() < 0.9 else rng.randint(4096, 32768),
+	"power_of_2": lambda rng: 1 << rng.randint(4, 12),
+	"fixed": lambda rng: rng.choice([24, 48, 100, 200, 500]),
+}
+
+
+def synthetic_trace(distribution, num_mallocs=NUM_MALLOCS, mean_lifetime=MEAN_LIFETIME, seed=0):
+	rng = random.Random(seed)
+	sample_size = SIZE_DISTRIBUTIONS[distribution]
+	trace = []
+	# (time of death, id) of the live allocations.
+	deaths = []
+	for i in range(num_mallocs):
+		while deaths and deaths[0][0] <= i:
+			_, j = heapq.heappop(deaths)
+			trace.append(("free", j))
+		trace.append(("malloc", i, sample_size(rng)))
+		heapq.heappush(deaths, (i + rng.expovariate(1 / mean_lifetime), i))
+	while deaths:
+		_, j = heapq.heappop(deaths)
+		trace.append(("free", j))
+	return trace
+
+
+def read_trace(trace_file):
+	trace = []
+	with open(trace_file) as fin:
+		for line in fin:
+			fields = line.split()
+			if not fields:
+				continue
+			if fields[0] == "malloc":
+				trace.append(("malloc", fields[1], int(fields[2])))
+			else:
+				assert fields[0] == "free"
+				trace.append(("free", fields[1]))
+	return trace
+
+
+def write_trace(trace, trace_file):
+	with open(trace_file, 'w') as fout:
+		for op in trace:
+			fout.write(" ".join(map(str, op)) + "\n")
+
+
+def _reserved_size(memory_manager, start, size):
+	if hasattr(memory_manager, "size"):
+		return memory_manager.size(start)
+	return size
+
+
+def _largest_free_block(memory_manager):
+	if isinstance(memory_manager, SlabMemoryManager):
+		memory_manager = memory_manager.buddy
+	if isinstance(memory_manager, BuddyMemoryManager):
+		return memory_manager._longest[0]
+	return max((end - start for start, end in memory_manager.free_list), default=0)
+
+
+def replay(memory_manager, trace, capacity=CAPACITY, sample_every=SAMPLE_EVERY):
+	id_to_start = {}
+	requested = 0
+	reserved = 0
+	num_mallocs = 0
+	num_failures = 0
+	num_frees = 0
+	peak_extent = 0
+	elapsed = 0.0
+	samples = []
+	for i, op in enumerate(trace):
+		if op[0] == "malloc":
+			_, alloc_id, size = op
+			num_mallocs += 1
+			t = time.perf_counter()
+			start = memory_manager.malloc(size)
+			elapsed += time.perf_counter() - t
+			if start == -1:
+				num_failures += 1
+			else:
+				reserved_size = _reserved_size(memory_manager, start, size)
+				id_to_start[alloc_id] = (start, size, reserved_size)
+				requested += size
+				reserved += reserved_size
+				peak_extent = max(peak_extent, start + reserved_size)
+		elif op[1] in id_to_start:
+			start, size, reserved_size = id_to_start.pop(op[1])
+			t = time.perf_counter()
+			freed = memory_manager.free(start)
+			elapsed += time.perf_counter() - t
+			assert freed
+			num_frees += 1
+			requested -= size
+			reserved -= reserved_size
+
+		if (i + 1) % sample_every == 0:
+			free = capacity - reserved
+			external = 1 - _largest_free_block(memory_manager) / free if free > 0 else 0.0
+			internal = 1 - requested / reserved if reserved > 0 else 0.0
+			samples.append({"op": i + 1, "external": external, "internal": internal})
+
+	num_samples = max(len(samples), 1)
+	return {
+		"ops_per_sec": (num_mallocs + num_frees) / elapsed if elapsed > 0 else float("inf"),
+		"failure_rate": num_failures / num_mallocs if num_mallocs > 0 else 0.0,
+		"peak_extent": peak_extent,
+		"external_fragmentation": sum(s["external"] for s in samples) / num_samples,
+		"internal_fragmentation": sum(s["internal"] for s in samples) / num_samples,
+		"samples": samples,
+	}
+
+
+def write_samples(samples, samples_file):
+	with open(samples_file, 'w', newline='') as fout:
+		writer = csv.DictWriter(fout, fieldnames=["op", "external", "internal"])
+		writer.writeheader()
+		writer.writerows(samples)
+
+
+def benchmark(trace, capacity=CAPACITY, samples_dir=None, prefix=""):
+	print(f"{'memory manager':<16} {'ops/s':>10} {'failures':>9} {'peak extent':>12} "
+		f"{'external':>9} {'internal':>9}")
+	for name, memory_manager in MEMORY_MANAGERS.items():
+		result = replay(memory_manager(capacity), trace, capacity)
+		print(f"{name:<16} {result['ops_per_sec']:>10.0f} {result['failure_rate']:>9.3f} "
+			f"{result['peak_extent']:>12} {result['external_fragmentation']:>9.3f} "
+			f"{result['internal_fragmentation']:>9.3f}")
+		if samples_dir is not None:
+			write_samples(result["samples"], os.path.join(samples_dir, f"{prefix}{name}.csv"))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('trace_file', nargs='?', help='Recorded trace to replay')
+	parser.add_argument('--samples_dir', help='Directory to which the fragmentation samples are written')
+	args = parser.parse_args()
+	if args.samples_dir is not None:
+		os.makedirs(args.samples_dir, exist_ok=True)
+	if args.trace_file is not None:
+		benchmark(read_trace(args.trace_file), samples_dir=args.samples_dir)
+		return
+	for distribution in SIZE_DISTRIBUTIONS:
+		print(f"# {distribution}")
+		benchmark(synthetic_trace(distribution), samples_dir=args.samples_dir,
+			prefix=f"{distribution}_")
+		print()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,248 @@
+"""Implementation of malloc and free with segregated free lists.
+
+Like memory_manager.py, except that malloc and free take O(1) time instead
+of O(n) and O(n log n) time, where n is the number of free spans.
+
+We keep a free list per size class. Size class k holds the free spans whose
+size is in [2^k, 2^(k+1)). Each free list is a doubly linked list of spans,
+so we can remove any span from its list in O(1) time.
+
+When we call malloc, we look for a free span in the smallest size class
+whose spans are all large enough for the request, i.e., the class of the
+smallest power of 2 that is greater than or equal to the requested size. An
+integer bitmap has bit k set if the free list of size class k is not empty,
+so we find the first non-empty size class at or above that class with a
+couple of bit operations and take the span at the head of its free list.
+If there is no such span, then we fall back to a first-fit search of the
+size class of the requested size itself, which may have a span that is
+large enough (e.g., a span of size 1000 for a request of size 1000). As in
+memory_manager.py, we reserve the start of the span and the rest of the
+span (if any) goes back into the free list of its new size class.
+
+When we call free, we look up the neighbors of the freed range in 2 maps:
+from the start address of a free span to its node and from the end address
+of a free span to its node. These maps are like the "boundary tags" in the
+headers and footers of the blocks of a real allocator: the free span to the
+right of [start, end) starts at end and the free span to the left ends at
+start. We remove the neighbors from their free lists, merge them with the
+freed range and insert the merged span into the free list of its size class.
+
+Notes:
+* Taking the head of a size class above the class of the request is a
+  "good fit" rather than a best fit, so it may split a larger span than
+  necessary.
+* The fallback search of the size class of the request is linear in the
+  length of that free list, but it only looks at spans whose size is within
+  a factor of 2 of the request.
+* The free_list property sorts the free spans by address and is only used
+  for testing.
+
+Run tests:
+
+pytest segregated_memory_manager.py
+
+See also:
+* memory_manager.py
+* ostep_free_space_management.md
+
+Sources:
+* https://pages.cs.wisc.edu/~remzi/OSTEP/vm-freespace.pdf
+* https://www.gnu.org/software/libc/manual/html_node/The-GNU-Allocator.html
+* Dynamic Storage Allocation: A Survey and Critical Review, Wilson et al. (https://www.cs.hmc.edu/~oneill/gc-library/Wilson-Alloc-Survey-1995.pdf)
+"""
+class Node:
+
+	def __init__(self, start, end):
+		self.start = start
+		self.end = end
+		self.prev = None
+		self.next = None
+
+
+class SegregatedMemoryManager:
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.start_to_size = {}
+		# Head of the free list of each size class.
+		self.heads = [None] * max(capacity.bit_length(), 1)
+		# Bit k is set if the free list of size class k is not empty.
+		self.nonempty = 0
+		# "Boundary tags" of the free spans.
+		self.start_to_node = {}
+		self.end_to_node = {}
+		if capacity > 0:
+			self._insert(Node(0, capacity))
+
+	def _insert(self, node):
+		k = (node.end - node.start).bit_length() - 1
+		node.prev = None
+		node.next = self.heads[k]
+		if node.next:
+			node.next.prev = node
+		self.heads[k] = node
+		self.nonempty |= 1 << k
+		self.start_to_node[node.start] = node
+		self.end_to_node[node.end] = node
+
+	def _remove(self, node):
+		k = (node.end - node.start).bit_length() - 1
+		if node.prev:
+			node.prev.next = node.next
+		else:
+			self.heads[k] = node.next
+			if not node.next:
+				self.nonempty &= ~(1 << k)
+		if node.next:
+			node.next.prev = node.prev
+		del self.start_to_node[node.start]
+		del self.end_to_node[node.end]
+
+	def _find(self, size):
+		# Every span in size class k is large enough if 2^k >= size.
+		k = (size - 1).bit_length()
+		classes = self.nonempty >> k << k
+		if classes:
+			# Lowest set bit.
+			return self.heads[(classes & -classes).bit_length() - 1]
+
+		# First fit in the size class of the request.
+		k = size.bit_length() - 1
+		if k < len(self.heads):
+			node = self.heads[k]
+			while node:
+				if node.end - node.start >= size:
+					return node
+				node = node.next
+		return None
+
+	def malloc(self, size):
+		assert size > 0
+		node = self._find(size)
+
+		# Insufficient space.
+		if not node:
+			return -1
+
+		start = node.start
+		self._remove(node)
+		if node.end - node.start > size:
+			node.start += size
+			self._insert(node)
+
+		self.start_to_size[start] = size
+
+		return start
+
+	def free(self, start):
+		if start not in self.start_to_size:
+			return False
+
+		size = self.start_to_size.pop(start)
+		node = Node(start, start + size)
+
+		# Coalesce with the free span to the right.
+		right = self.start_to_node.get(node.end)
+		if right:
+			self._remove(right)
+			node.end = right.end
+
+		# Coalesce with the free span to the left.
+		left = self.end_to_node.get(node.start)
+		if left:
+			self._remove(left)
+			node.start = left.start
+
+		self._insert(node)
+
+		return True
+
+	@property
+	def free_list(self):
+		# for testing.
+		return sorted([node.start, node.end] for node in self.start_to_node.values())
+
+########
+# Tests
+########
+
+
+import pytest
+import random
+
+# The tests of memory_manager.py run against the `memory_manager` fixture
+# below. test_fuzz below replaces its fuzz test.
+from memory_manager import (
+	_max_size,
+	test_init,
+	test_malloc_ok,
+	test_malloc_fail,
+	test_free_ok,
+	test_free_fail,
+	test_multiple_malloc,
+	test_fragmentation,
+	test_coalesce,
+)
+
+
+@pytest.fixture
+def memory_manager():
+	return SegregatedMemoryManager(1000)
+
+
+def test_malloc_exact_fit(memory_manager):
+	# [0, 1000) is in the size class [512, 1024), which is not
+	# large enough for every request of size 1000.
+	start0 = memory_manager.malloc(1000)
+	assert start0 == 0
+	assert memory_manager.free_list == []
+	assert memory_manager.nonempty == 0
+
+
+def test_size_class(memory_manager):
+	# Reserve [0, 100), [100, 400) and [400, 410)
+	start0 = memory_manager.malloc(100)
+	start1 = memory_manager.malloc(300)
+	start2 = memory_manager.malloc(10)
+	# Free [0, 100) and [100, 400) stays reserved.
+	assert memory_manager.free(start0)
+	assert memory_manager.free_list == [[0, 100], [410, 1000]]
+	# A request of size 50 is served from the size class [64, 128)
+	# instead of the first span that is large enough.
+	start3 = memory_manager.malloc(50)
+	assert start3 == 0
+	assert memory_manager.free_list == [[50, 100], [410, 1000]]
+
+
+def test_fuzz(memory_manager):
+	"""Fuzz test.
+
+	Same as test_fuzz in memory_manager.py, except that we
+	also check that the size class bitmap matches the free lists.
+	"""
+	random.seed(0)
+	starts = []
+	for thd in [0.25, 0.5, 0.75]:
+		for _ in range(10000):
+			r = random.random()
+			max_size = _max_size(memory_manager)
+			if (max_size > 0) and ((not starts) or (r <= thd)):
+				# Sample an index in [1, max_size] inclusive.
+				size = random.randint(1, max_size)
+				start = memory_manager.malloc(size)
+				assert start != -1
+				starts.append(start)
+			else:
+				# Sample an index in [0, len(starts) - 1] inclusive.
+				i = random.randint(0, len(starts) - 1)
+				start = starts.pop(i)
+				assert memory_manager.free(start)
+			for k, head in enumerate(memory_manager.heads):
+				assert bool(memory_manager.nonempty & (1 << k)) == (head is not None)
+
+	random.shuffle(starts)
+	while starts:
+		start = starts.pop()
+		memory_manager.free(start)
+
+	assert memory_manager.free_list == [[0, 1000]]
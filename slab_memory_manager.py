@@ -0,0 +1,292 @@
+"""Slab allocator on top of a buddy allocator.
+
+A buddy allocator rounds every request up to a power of 2, so a request
+for 24 bytes reserves 32 bytes and a request for 200 bytes reserves 256
+bytes, and every call walks the buddy tree. When most requests are for a
+few fixed object sizes, a slab allocator does better.
+
+We initialize the SlabMemoryManager with the `size` of the arena, the
+object sizes to cache and a `slab_size`. It keeps a cache per object size.
+A cache gets blocks of `slab_size` bytes ("slabs") from the buddy allocator
+and carves each slab into `slab_size // object_size` slots. Each slab
+tracks its free slots with a bitmap (an int with bit i set if slot i is
+free).
+
+The malloc method serves a request from the cache of the smallest object
+size that is greater than or equal to the requested size. The cache keeps
+a doubly linked list of its slabs that have a free slot. It takes the slab
+at the head of the list and the lowest free slot of that slab (the lowest
+set bit of the bitmap). If the list is empty, then it gets a new slab from
+the buddy allocator. A request that is larger than every object size goes
+to the buddy allocator directly.
+
+The free method finds the slab of an address from its slab number
+`start // slab_size` (slabs are aligned, because buddy blocks are aligned
+to their size) and sets the bit of the slot. A slab that was full goes back
+onto the list of its cache. A slab that becomes empty goes back to the
+buddy allocator, so the memory can be used for other sizes. An address
+that is not in a slab is freed by the buddy allocator.
+
+Notes:
+* malloc and free of a cached size take O(1) time: they don't touch the
+  buddy allocator unless a slab is created or returned.
+* The internal fragmentation of an object is at most the difference
+  between its size and the object size of its cache plus the unused tail of
+  its slab (`slab_size % object_size`) shared by all the objects of a slab.
+* Returning a slab as soon as it is empty can thrash when a single object
+  is allocated and freed over and over at the boundary of a slab. The Linux
+  SLAB allocator keeps a few empty slabs around for that reason.
+
+Run tests:
+
+pytest slab_memory_manager.py
+
+See also:
+* buddy_memory_manager.py
+* ostep_free_space_management.md
+
+Sources:
+* The Slab Allocator: An Object-Caching Kernel Memory Allocator, Jeff Bonwick (https://www.usenix.org/legacy/publications/library/proceedings/bos94/full_papers/bonwick.a)
+* https://www.kernel.org/doc/gorman/html/understand/understand011.html
+"""
+import bisect
+
+from buddy_memory_manager import BuddyMemoryManager, _is_pow_of_2
+
+
+class Slab:
+
+	def __init__(self, start, num_slots):
+		self.start = start
+		# Bit i is set if slot i is free.
+		self.free_slots = (1 << num_slots) - 1
+		self.num_free = num_slots
+		self.prev = None
+		self.next = None
+
+
+class Cache:
+
+	def __init__(self, object_size, slab_size):
+		self.object_size = object_size
+		self.num_slots = slab_size // object_size
+		# Slabs with at least 1 free slot.
+		self.head = None
+
+	def push(self, slab):
+		slab.prev = None
+		slab.next = self.head
+		if slab.next:
+			slab.next.prev = slab
+		self.head = slab
+
+	def remove(self, slab):
+		if slab.prev:
+			slab.prev.next = slab.next
+		else:
+			self.head = slab.next
+		if slab.next:
+			slab.next.prev = slab.prev
+		slab.prev = None
+		slab.next = None
+
+
+class SlabMemoryManager:
+
+	def __init__(self, size, object_sizes, slab_size=4096):
+		assert _is_pow_of_2(slab_size) and slab_size <= size
+		assert all(0 < object_size <= slab_size for object_size in object_sizes)
+
+		self.buddy = BuddyMemoryManager(size)
+		self.slab_size = slab_size
+		self.object_sizes = sorted(set(object_sizes))
+		self.caches = [Cache(object_size, slab_size) for object_size in self.object_sizes]
+		# Map from slab number to (cache, slab).
+		self.slabs = {}
+
+	def malloc(self, size):
+		i = bisect.bisect_left(self.object_sizes, max(size, 1))
+		if i == len(self.caches):
+			return self.buddy.malloc(size)
+
+		cache = self.caches[i]
+		slab = cache.head
+		if not slab:
+			start = self.buddy.malloc(self.slab_size)
+			if start == -1:
+				return -1
+			slab = Slab(start, cache.num_slots)
+			self.slabs[start // self.slab_size] = (cache, slab)
+			cache.push(slab)
+
+		# Lowest free slot.
+		j = (slab.free_slots & -slab.free_slots).bit_length() - 1
+		slab.free_slots &= ~(1 << j)
+		slab.num_free -= 1
+		if slab.num_free == 0:
+			cache.remove(slab)
+
+		return slab.start + j * cache.object_size
+
+	def free(self, start):
+		if start < 0:
+			return False
+
+		entry = self.slabs.get(start // self.slab_size)
+		if not entry:
+			return self.buddy.free(start)
+
+		cache, slab = entry
+		j, offset = divmod(start - slab.start, cache.object_size)
+		if (offset != 0) or (j >= cache.num_slots) or (slab.free_slots >> j) & 1:
+			# Not the start of a slot or the slot is already free.
+			return False
+
+		slab.free_slots |= 1 << j
+		slab.num_free += 1
+		if slab.num_free == 1:
+			# The slab was full.
+			cache.push(slab)
+		if slab.num_free == cache.num_slots:
+			# The slab is empty.
+			cache.remove(slab)
+			del self.slabs[slab.start // self.slab_size]
+			freed = self.buddy.free(slab.start)
+			assert freed
+
+		return True
+
+	def size(self, start):
+		entry = self.slabs.get(start // self.slab_size)
+		if not entry:
+			return self.buddy.size(start)
+		cache, _ = entry
+		return cache.object_size
+
+########
+# Tests
+########
+
+
+import pytest
+import random
+
+
+@pytest.fixture
+def slab():
+	return SlabMemoryManager(1024, object_sizes=[24, 100], slab_size=256)
+
+
+def test_init(slab):
+	assert str(slab.buddy) == "(0:1024)"
+
+
+def test_malloc_ok(slab):
+	# The first object of size 24 gets a slab [0, 256).
+	start0 = slab.malloc(24)
+	assert start0 == 0
+	assert str(slab.buddy) == "(([0:256](256:256))(512:512))"
+	# The next objects are in the same slab.
+	start1 = slab.malloc(24)
+	assert start1 == 24
+	# A smaller request is served by the cache of size 24.
+	start2 = slab.malloc(10)
+	assert start2 == 48
+	assert slab.size(start2) == 24
+
+
+def test_malloc_other_size(slab):
+	start0 = slab.malloc(24)
+	# An object of size 100 gets its own slab [256, 512).
+	start1 = slab.malloc(100)
+	assert start1 == 256
+	start2 = slab.malloc(100)
+	assert start2 == 356
+	# A request larger than every object size goes to the buddy
+	# allocator.
+	start3 = slab.malloc(300)
+	assert start3 == 512
+	assert slab.size(start3) == 512
+
+
+def test_full_slab(slab):
+	# A slab of size 256 has 10 slots of size 24.
+	starts = [slab.malloc(24) for _ in range(11)]
+	assert starts == [24 * j for j in range(10)] + [256]
+	# Free a slot of the full slab and reuse it.
+	assert slab.free(starts[3])
+	assert slab.malloc(24) == starts[3]
+
+
+def test_free_ok(slab):
+	start0 = slab.malloc(24)
+	start1 = slab.malloc(24)
+	assert slab.free(start0)
+	assert slab.malloc(24) == start0
+	assert slab.free(start0)
+	# The slab is empty, so it goes back to the buddy allocator.
+	assert slab.free(start1)
+	assert str(slab.buddy) == "(0:1024)"
+	assert slab.slabs == {}
+
+
+def test_free_fail(slab):
+	start0 = slab.malloc(24)
+	# Not the start of a slot.
+	assert not slab.free(start0 + 1)
+	# A free slot.
+	assert not slab.free(start0 + 24)
+	# In the tail of the slab after the last slot.
+	assert not slab.free(240)
+	assert slab.free(start0)
+	# Double free.
+	assert not slab.free(start0)
+
+
+def test_internal_fragmentation():
+	slab = SlabMemoryManager(1 << 16, object_sizes=[24], slab_size=4096)
+	for _ in range(1000):
+		assert slab.malloc(24) != -1
+	# 170 objects of size 24 per slab, so 6 slabs instead of the
+	# 1000 * 32 bytes of the buddy allocator.
+	assert len(slab.slabs) == 6
+
+
+def test_fuzz(slab):
+	"""Fuzz test.
+
+	Malloc a random size or free a random reserved start address with a
+	biased coin as in test_fuzz in buddy_memory_manager.py and check that
+	the reserved ranges never overlap. At the end, free everything and
+	check that every slab went back to the buddy allocator.
+	"""
+	random.seed(0)
+	starts = []
+	reserved = [False] * 1024
+	for thd in [0.25, 0.5, 0.75]:
+		for _ in range(10000):
+			r = random.random()
+			if (not starts) or (r <= thd):
+				size = random.choice([1, 24, 50, 100, 200, 300])
+				start = slab.malloc(size)
+				if start == -1:
+					continue
+				assert slab.size(start) >= size
+				for i in range(start, start + size):
+					assert not reserved[i]
+					reserved[i] = True
+				starts.append((start, size))
+			else:
+				i = random.randint(0, len(starts) - 1)
+				start, size = starts.pop(i)
+				for i in range(start, start + size):
+					reserved[i] = False
+				assert slab.free(start)
+
+	random.shuffle(starts)
+	while starts:
+		start, _ = starts.pop()
+		assert slab.free(start)
+
+	assert str(slab.buddy) == "(0:1024)"
+	assert slab.slabs == {}
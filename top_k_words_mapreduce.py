@@ -5,6 +5,23 @@
 Use `mapreduce.py` to write out a jsonl file with a line for each
 of the top K most frequently occurring words in all the text files.
 
+# Notes
+
+* If every mapper emits its (word, count) pairs under a single key, then all
+  V words of the vocabulary are shuffled to a single reducer. Instead, we
+  compute the top K in a tree:
+  * The combiner keeps the top K of each key in a map task, so a map task
+    shuffles at most K pairs per key.
+  * The mapper spreads the words over `NUM_GROUPS` keys by hashing the word,
+    so `NUM_GROUPS` reducers compute the top K of their group in parallel
+    from at most M x K pairs each.
+  * The driver computes the top K of the `NUM_GROUPS` x K pairs that the
+    reducers write out.
+* The shuffle volume and the work of the last stage depend on M, K and
+  `NUM_GROUPS` but not on V. The "shuffle_records" counter in
+  tmp/counters.json shows the shuffle volume.
+* On a tie, the word that comes first wins.
+
 # Usage
 
 ```bash
@@ -15,42 +32,57 @@ of the top K most frequently occurring words in all the text files.
 > rm tmp/*-*.jsonl tmp/split_* tmp/out.jsonl
 > python top_k_words_mapreduce.py
 """
+import hashlib
 import heapq
 import jsonlines
 import os
 
 import mapreduce
 
+TOP_K = 5
+NUM_GROUPS = 4
+
+def _top_k(word_and_counts):
+	return heapq.nsmallest(
+		TOP_K, word_and_counts, key=lambda word_and_count: (-word_and_count[1], word_and_count[0]))
+
 def mapper(key, value):
-	# group all by the same key
-	kv = jsonlines.Reader([value]).read()
-	yield "ONE_KEY", kv
+	word, count = jsonlines.Reader([value]).read()
+	h = int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16)
+	yield str(h % NUM_GROUPS), [word, count]
 
-def reducer(key, values):
+def combiner(key, values):
 	del key
-	top_k = 5
-	min_heap = []
-	for word, count in values:
-		heapq.heappush(min_heap, (count, word))
-		if len(min_heap) > top_k:
-			heapq.heappop(min_heap)	
+	yield _top_k(values)
 
-	while min_heap:
-		count, word = heapq.heappop(min_heap)
-		yield [(word, count)]
+def reducer(key, values):
+	del key
+	yield _top_k(values)
 
 if __name__ == "__main__":
+	# The inputs are the output splits of word_count_mapreduce.py.
 	chunks = []
-	for i, f in enumerate(os.listdir(mapreduce.BASE_DIR)):
+	for i, f in enumerate(sorted(os.listdir(mapreduce.BASE_DIR))):
+		if not f.startswith("out_"):
+			continue
 		chunks.append(
 			{"path": os.path.join(mapreduce.BASE_DIR, f), "machine": i % 2})
 
-	num_reduce_partitions = 1
+	num_reduce_partitions = NUM_GROUPS
 
 	mapreduce.mapreduce(
 		chunks,
 		mapper,
 		reducer,
 		num_reduce_partitions,
-		combiner=None
-	)
\ No newline at end of file
+		combiner=combiner
+	)
+
+	word_and_counts = []
+	with jsonlines.open(mapreduce.OUTPUT_FILE, 'r') as fin:
+		for _, word_and_count in fin:
+			word_and_counts.append(word_and_count)
+
+	with jsonlines.open(mapreduce.OUTPUT_FILE, 'w') as fout:
+		for word_and_count in _top_k(word_and_counts):
+			fout.write(word_and_count)
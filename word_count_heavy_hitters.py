@@ -0,0 +1,232 @@
+"""Approximate top K words in bounded memory.
+
+# Problem
+
+Given a text file, write out a jsonl file with a line for each of the
+top K most frequently occurring words in the text file and where the
+line has the form [word, count]. Sort the lines by count (descending).
+
+Assume that neither the input file nor the vocabulary fit into memory,
+so `word_count_in_memory.py` runs out of memory and `word_count_on_disk.py`
+costs a full external sort.
+
+# Notes
+
+* We trade exact counts for fixed memory with 2 summaries of the stream:
+  * A **Count-Min sketch** is a `depth` x `width` table of counters. Each
+    row hashes a word to one of its counters. Adding a word increments its
+    counter in every row and the estimate of its count is the minimum over
+    the rows. Collisions only add to a counter, so the estimate never
+    underestimates. With `width = ceil(e / epsilon)` and
+    `depth = ceil(ln(1 / delta))`, the estimate is at most
+    `epsilon * N` too large with probability at least `1 - delta`, where
+    `N` is the number of tokens.
+  * A **Space-Saving** table keeps a counter for at most `capacity` words.
+    A word that is not in a full table replaces the word with the smallest
+    count and inherits that count (the count is an overestimate and the
+    inherited count is its maximum error). With `capacity >= 1 / epsilon`,
+    every word with a count above `epsilon * N` is in the table.
+* The Space-Saving table gives the candidates for the top K and the
+  estimate of a candidate is the minimum of its Space-Saving count and its
+  Count-Min estimate (both are overestimates).
+* Both summaries are mergeable, so each worker summarizes its own range of
+  the input and we merge the summaries. Count-Min sketches with the same
+  shape and hash functions merge by adding the tables. Space-Saving tables
+  merge by adding the counts, where a word missing from a full table gets
+  the smallest count of that table, and keeping the `capacity` largest
+  counts (Agarwal et al.).
+* The hash functions have to be the same in every worker, so we use
+  blake2b instead of `hash` (which is salted per process). We derive the
+  row hashes from one 128-bit digest with double hashing:
+  `h_i = h1 + i * h2` (Kirsch and Mitzenmacher).
+* We read and tokenize the input in large blocks with `word_tokenizer.py`.
+* We count a block of lines exactly with a `collections.Counter` first and
+  then add each distinct word to the summaries once with its count, so
+  the Count-Min updates are vectorized with NumPy.
+* The Space-Saving table finds the word with the smallest count with a
+  min-heap. We push a new entry when a count changes instead of updating
+  the entry in place, skip entries that no longer match the table when
+  we pop, and rebuild the heap when it gets too big.
+
+# Usage
+
+```bash
+> wget https://www.gutenberg.org/files/84/84-0.txt
+> python word_count_heavy_hitters.py 84-0.txt out.jsonl 100 [num_workers]
+```
+
+Sources:
+* https://en.wikipedia.org/wiki/Count%E2%80%93min_sketch
+* https://www.cs.ucsb.edu/sites/default/files/documents/2005-23.pdf (Space-Saving)
+* https://www.cs.utah.edu/~jeffp/papers/merge-summ.pdf (Mergeable Summaries)
+* https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf (double hashing)
+"""
+import collections
+import hashlib
+import heapq
+import jsonlines
+import math
+import multiprocessing
+import numpy as np
+import sys
+
+import word_tokenizer
+
+def _hashes(words):
+	"""Returns two 64-bit hashes for each word."""
+	digests = b"".join(
+		hashlib.blake2b(word.encode("utf-8"), digest_size=16).digest()
+		for word in words)
+	hashes = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+	# Make h2 odd, so that the rows don't collapse when h2 is 0.
+	return hashes[:, 0], hashes[:, 1] | np.uint64(1)
+
+class CountMinSketch:
+
+	def __init__(self, epsilon, delta):
+		self.width = math.ceil(math.e / epsilon)
+		self.depth = math.ceil(math.log(1 / delta))
+		self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+
+	def _columns(self, words):
+		h1, h2 = _hashes(words)
+		rows = np.arange(self.depth, dtype=np.uint64)[:, np.newaxis]
+		# uint64 arithmetic wraps around, which is fine for hashing.
+		return ((h1 + rows * h2) % np.uint64(self.width)).astype(np.intp)
+
+	def update(self, words, counts):
+		if not words:
+			return
+		columns = self._columns(words)
+		rows = np.arange(self.depth)[:, np.newaxis]
+		counts = np.broadcast_to(np.asarray(counts, dtype=np.int64), columns.shape)
+		np.add.at(self.table, (rows, columns), counts)
+
+	def estimate(self, words):
+		if not words:
+			return np.zeros(0, dtype=np.int64)
+		columns = self._columns(words)
+		rows = np.arange(self.depth)[:, np.newaxis]
+		return self.table[rows, columns].min(axis=0)
+
+	def merge(self, other):
+		assert self.table.shape == other.table.shape
+		self.table += other.table
+
+class SpaceSaving:
+
+	def __init__(self, capacity):
+		assert capacity >= 1
+		self.capacity = capacity
+		self.word_to_count = {}
+		self.word_to_error = {}
+		# Contains (count, word) entries that may be stale.
+		self._heap = []
+
+	def _push(self, word):
+		heapq.heappush(self._heap, (self.word_to_count[word], word))
+		if len(self._heap) > 4 * self.capacity:
+			self._heap = [(count, word) for word, count in self.word_to_count.items()]
+			heapq.heapify(self._heap)
+
+	def _pop_min(self):
+		while True:
+			count, word = heapq.heappop(self._heap)
+			if self.word_to_count.get(word) == count:
+				del self.word_to_count[word]
+				del self.word_to_error[word]
+				return count
+
+	def add(self, word, count=1):
+		if word in self.word_to_count:
+			self.word_to_count[word] += count
+		elif len(self.word_to_count) < self.capacity:
+			self.word_to_count[word] = count
+			self.word_to_error[word] = 0
+		else:
+			min_count = self._pop_min()
+			self.word_to_count[word] = min_count + count
+			self.word_to_error[word] = min_count
+		self._push(word)
+
+	def _min_count(self):
+		# A word that is missing from a table that isn't full has a count of 0.
+		if len(self.word_to_count) < self.capacity:
+			return 0
+		return min(self.word_to_count.values())
+
+	def merge(self, other):
+		min_count = self._min_count()
+		other_min_count = other._min_count()
+		word_to_count = {}
+		word_to_error = {}
+		for word in self.word_to_count.keys() | other.word_to_count.keys():
+			word_to_count[word] = self.word_to_count.get(word, min_count) + \
+				other.word_to_count.get(word, other_min_count)
+			word_to_error[word] = self.word_to_error.get(word, min_count) + \
+				other.word_to_error.get(word, other_min_count)
+		words = heapq.nlargest(self.capacity, word_to_count, key=word_to_count.get)
+		self.word_to_count = {word: word_to_count[word] for word in words}
+		self.word_to_error = {word: word_to_error[word] for word in words}
+		self._heap = [(count, word) for word, count in self.word_to_count.items()]
+		heapq.heapify(self._heap)
+
+class HeavyHitters:
+
+	def __init__(self, epsilon=1e-4, delta=1e-3, k=1000):
+		self.sketch = CountMinSketch(epsilon, delta)
+		self.summary = SpaceSaving(max(k, math.ceil(1 / epsilon)))
+
+	def update(self, word_to_count):
+		words = list(word_to_count)
+		self.sketch.update(words, [word_to_count[word] for word in words])
+		for word in words:
+			self.summary.add(word, word_to_count[word])
+
+	def merge(self, other):
+		self.sketch.merge(other.sketch)
+		self.summary.merge(other.summary)
+
+	def top_k(self, k):
+		words = list(self.summary.word_to_count)
+		estimates = self.sketch.estimate(words)
+		word_and_counts = []
+		for word, estimate in zip(words, estimates):
+			count = min(self.summary.word_to_count[word], int(estimate))
+			word_and_counts.append((word, count))
+		word_and_counts.sort(key=lambda x: (-x[1], x[0]))
+		return word_and_counts[:k]
+
+def _summarize_range(input_file, start, end, epsilon, delta, k):
+	heavy_hitters = HeavyHitters(epsilon, delta, k)
+	for block in word_tokenizer.read_blocks(input_file, start, end):
+		heavy_hitters.update(
+			collections.Counter(word_tokenizer.tokenize_block(block)))
+	return heavy_hitters
+
+def word_count(input_file, output_file, k, num_workers=1, epsilon=1e-4, delta=1e-3):
+	offsets = word_tokenizer.line_aligned_offsets(input_file, num_workers)
+	args = []
+	for i in range(num_workers):
+		args.append((input_file, offsets[i], offsets[i + 1], epsilon, delta, k))
+
+	if num_workers == 1:
+		heavy_hitters = _summarize_range(*args[0])
+	else:
+		with multiprocessing.Pool(num_workers) as pool:
+			summaries = pool.starmap(_summarize_range, args)
+		heavy_hitters = summaries[0]
+		for other in summaries[1:]:
+			heavy_hitters.merge(other)
+
+	with jsonlines.open(output_file, 'w') as fout:
+		for word, count in heavy_hitters.top_k(k):
+			fout.write([word, count])
+
+if __name__ == "__main__":
+	assert len(sys.argv) in (4, 5)
+	input_file = sys.argv[1]
+	output_file = sys.argv[2]
+	k = int(sys.argv[3])
+	num_workers = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+	word_count(input_file, output_file, k, num_workers)
@@ -11,31 +11,55 @@ the output file does.
 
 # Notes
 
-* We stream the input file in line-by-line and accumulate
-  the counts with an in-memory dictionary.
+* We stream the input file in large line-aligned blocks and accumulate
+  the counts with an in-memory dictionary. We count a whole block at a time
+  with the tokenizer in `word_tokenizer.py` and `collections.Counter`, which
+  counts in C.
 * We treat each punctuation character has its own token.\
+* With `num_workers` > 1, we cut the input into `num_workers` ranges at
+  line-aligned byte offsets and count each range in a worker process.
+* The partial Counters are merged in the parent process. Each one is
+  pickled once, on its way back from its worker. A tree reduction that
+  merges pairs of Counters in the workers would send every vocabulary-sized
+  Counter to a worker and back again in every round.
 
 # Usage
 
 ```bash
 > wget https://www.gutenberg.org/files/84/84-0.txt
-> python word_count_in_memory.py 84-0.txt out.jsonl
+> python word_count_in_memory.py 84-0.txt out.jsonl [num_workers]
 ```
 """
 import collections
 import jsonlines
-import re
+import multiprocessing
+import os
 import sys
 
-def _tokenize(text):
-	return re.findall(r"(\w+|[^\s\w])", text)
+import word_tokenizer
 
-def word_count(input_file, output_file):
-	word_to_count = collections.defaultdict(int)
-	with open(input_file, 'r') as fin:
-		for line in fin:
-			for word in _tokenize(line):
-				word_to_count[word] += 1
+def _count_range(input_file, start, end):
+	word_to_count = collections.Counter()
+	for block in word_tokenizer.read_blocks(input_file, start, end):
+		word_to_count.update(word_tokenizer.tokenize_block(block))
+	return word_to_count
+
+def _parallel_word_count(input_file, num_workers):
+	offsets = word_tokenizer.line_aligned_offsets(input_file, num_workers)
+	with multiprocessing.Pool(num_workers) as pool:
+		counters = pool.starmap(
+			_count_range,
+			[(input_file, offsets[i], offsets[i + 1]) for i in range(num_workers)])
+	word_to_count = counters[0]
+	for other_word_to_count in counters[1:]:
+		word_to_count.update(other_word_to_count)
+	return word_to_count
+
+def word_count(input_file, output_file, num_workers=1):
+	if num_workers > 1:
+		word_to_count = _parallel_word_count(input_file, num_workers)
+	else:
+		word_to_count = _count_range(input_file, 0, os.path.getsize(input_file))
 
 	word_and_counts = list(word_to_count.items())
 	word_and_counts.sort()
@@ -45,7 +69,8 @@ def word_count(input_file, output_file):
 			fout.write([word, count])
 
 if __name__ == "__main__":
-	assert len(sys.argv) == 3
+	assert len(sys.argv) in (3, 4)
 	input_file = sys.argv[1]
 	output_file = sys.argv[2]
-	word_count(input_file, output_file)
\ No newline at end of file
+	num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else 1
+	word_count(input_file, output_file, num_workers)
\ No newline at end of file
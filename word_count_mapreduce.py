@@ -6,6 +6,13 @@ Use `mapreduce.py` to write out a jsonl file with a line for each
 unique word in all the text files and where the line has the
 form [word, count]. Sort the lines by word.
 
+# Notes
+
+* The mapper is a raw mapper: it gets the bytes of a whole chunk and
+  tokenizes them as one block with `word_tokenizer.tokenize_block`, instead
+  of being called and tokenizing once per line. A chunk from `split -l`
+  ends at the end of a line, so it is a valid block.
+
 # Usage
 
 ```bash
@@ -15,15 +22,12 @@ form [word, count]. Sort the lines by word.
 > python word_count_mapreduce.py
 """
 import os
-import re
 
 import mapreduce
-
-def _tokenize(text):
-	return re.findall(r"(\w+|[^\w\s])", text)
+import word_tokenizer
 
 def mapper(key, value):
-	for word in _tokenize(value):
+	for word in word_tokenizer.tokenize_block(value):
 		yield word, 1
 
 def combiner(key, values):
@@ -48,5 +52,6 @@ if __name__ == "__main__":
 		mapper,
 		reducer,
 		num_reduce_partitions,
-		combiner=combiner
+		combiner=combiner,
+		raw_mapper=True
 	)
\ No newline at end of file
@@ -14,97 +14,174 @@ fit into memory.
 * Don't forget about the last split
 * Don't write the last word twice if the last word happens to be different than
   penultimate word
-* Sorting the lines by count requires 2 external sorts in total
+* Sorting the lines by count with an external sort by word and then an
+  external sort by count requires 2 external sorts in total. `order="count"`
+  avoids the second one (see below).
 * Write the prev_word, not word
+* We count the words within a split before spilling it, so a split is
+  a sorted list of (word, count) pairs instead of every occurrence of every
+  word. `split_size` is the number of distinct words that we keep in memory
+  before spilling, and the splits add up to roughly the size of the
+  vocabulary times the number of splits instead of the size of the input.
+* The merge sums the counts of the same word across the splits.
+* A token never contains whitespace, so a split line is "word\tcount".
+* `order="count"` sorts the lines by count (descending, ties by word)
+  without a second external sort. The merge emits the words in sorted order
+  and we append each word to a bucket file for its count, so every bucket is
+  already sorted by word and the output is the buckets in descending order.
+  There is a bucket for every count from 1 to `NUM_COUNT_BUCKETS - 1` that
+  occurs, opened the first time a word has that count. The few words
+  with a larger count (in a Zipfian vocabulary, the number of words with a
+  count >= c is about V / c) are sorted in memory.
+* The split and bucket files are deleted once the output is written.
+* `top_k` writes only the K most frequent words. We stream the merged
+  counts through a min-heap of size K, so it needs O(K) memory. On a tie,
+  the word that comes first wins, like in the sort by count.
+* We read and tokenize the input in large blocks with `word_tokenizer.py`.
+* With `num_workers` > 1, we cut the input into `num_workers` ranges at
+  line-aligned byte offsets and each worker in a process pool tokenizes
+  its range and writes its own splits.
 
 # Usage
 
 ```bash
 > wget https://www.gutenberg.org/files/84/84-0.txt
 > mkdir tmp
-> python word_count_on_disk.py 84-0.txt tmp/split_ 50000 out.jsonl
+> python word_count_on_disk.py 84-0.txt tmp/split_ 50000 out.jsonl [num_workers] [word|count|K]
 ```
 """
 import collections
 import heapq
 import jsonlines
-import re
+import multiprocessing
+import os
 import sys
 
-def _tokenize(text):
-	return re.findall(r"(\w+|[^\w\s])", text)
+import word_tokenizer
 
-def _write_split(items, split_files):
-	items.sort()
+NUM_COUNT_BUCKETS = 100
+
+def _write_split(word_to_count, split_prefix, split_files):
 	split_file = f"{split_prefix}{len(split_files)}.txt"
 	with open(split_file, 'w') as fout:
-		for item in items:
-			fout.write(item + "\n")
+		for word in sorted(word_to_count):
+			fout.write(f"{word}\t{word_to_count[word]}\n")
 	split_files.append(split_file)
 
-def _external_sort(input_files, output_file):
-	fins = [open(input_file, 'r') for input_file in input_files]
-
-	heap = []
-	for i, fin in enumerate(fins):
-		heapq.heappush(heap, (fin.readline(), i))
-
-	fout = open(output_file, 'w')
-	fout.close()
-	fout = open(output_file, 'a')
-	while heap:
-		line, i = heapq.heappop(heap)
-
-		if not line:
-			fins[i].close()
-			continue
-
-		fout.write(line)
-		heapq.heappush(heap, (fins[i].readline(), i))
-	fout.close()
-
-def word_count(input_file, split_prefix, split_size, output_file):
-	assert split_size >= 1
+def _read_split(split_file):
+	with open(split_file, 'r') as fin:
+		for line in fin:
+			word, count = line.rstrip("\n").split("\t")
+			yield word, int(count)
 
+def _count_range(input_file, start, end, split_prefix, split_size):
 	split_files = []
-	words = []
-	with open(input_file, 'r') as fin:
-		for line in fin:
-			for word in _tokenize(line):
-				words.append(word)
-				if len(words) == split_size:
-					_write_split(words, split_files)
-					words.clear()
-	if words:
-		_write_split(words, split_files)
-
-	combined_split_file = f"{split_prefix}combined.txt"
-	_external_sort(split_files, combined_split_file)
-
-	fout = jsonlines.open(output_file, 'w')
-	fout.close()
-	fout = jsonlines.open(output_file, 'a')
-	with open(combined_split_file, 'r') as fin:
-		count = 0
-		prev_word = None
-		prev_word_written = None
-		for line in fin:
-			word = line.strip()
-			if prev_word is None or word == prev_word:
-				count += 1
-			else:
-				fout.write([prev_word, count])
-				prev_word_written = prev_word
-				count = 1
+	word_to_count = collections.Counter()
+	for block in word_tokenizer.read_blocks(input_file, start, end):
+		for word in word_tokenizer.tokenize_block(block):
+			word_to_count[word] += 1
+			if len(word_to_count) == split_size:
+				_write_split(word_to_count, split_prefix, split_files)
+				word_to_count.clear()
+	if word_to_count:
+		_write_split(word_to_count, split_prefix, split_files)
+	return split_files
+
+def _merge_counts(split_files):
+	prev_word = None
+	count = 0
+	for word, split_count in heapq.merge(*[_read_split(f) for f in split_files]):
+		if word != prev_word:
+			if prev_word is not None:
+				yield prev_word, count
 			prev_word = word
-		if word != prev_word_written:
+			count = 0
+		count += split_count
+	if prev_word is not None:
+		yield prev_word, count
+
+def _write_top_k(word_and_counts, k, output_file):
+	# The words arrive in sorted order, so on a tie the later word
+	# (the one with the larger i) is the smaller entry and gets evicted.
+	min_heap = []
+	for i, (word, count) in enumerate(word_and_counts):
+		if len(min_heap) < k:
+			heapq.heappush(min_heap, (count, -i, word))
+		else:
+			heapq.heappushpop(min_heap, (count, -i, word))
+	min_heap.sort(reverse=True)
+	with jsonlines.open(output_file, 'w') as fout:
+		for count, _, word in min_heap:
 			fout.write([word, count])
-	fout.close()
+
+def _write_by_count(word_and_counts, split_prefix, output_file):
+	# A bucket file is only created for a count that occurs.
+	fouts = {}
+	large_counts = []
+	for word, count in word_and_counts:
+		if count < NUM_COUNT_BUCKETS:
+			if count not in fouts:
+				fouts[count] = open(f"{split_prefix}count_{count}.txt", 'w')
+			fouts[count].write(word + "\n")
+		else:
+			large_counts.append((-count, word))
+	for fout in fouts.values():
+		fout.close()
+	large_counts.sort()
+
+	with jsonlines.open(output_file, 'w') as fout:
+		for neg_count, word in large_counts:
+			fout.write([word, -neg_count])
+		for count in sorted(fouts, reverse=True):
+			with open(fouts[count].name, 'r') as fin:
+				for line in fin:
+					fout.write([line.rstrip("\n"), count])
+
+	for bucket in fouts.values():
+		os.remove(bucket.name)
+
+def word_count(input_file, split_prefix, split_size, output_file, num_workers=1,
+		order="word", top_k=None):
+	assert split_size >= 1
+
+	if num_workers == 1:
+		split_files = _count_range(
+			input_file, 0, os.path.getsize(input_file), split_prefix, split_size)
+	else:
+		offsets = word_tokenizer.line_aligned_offsets(input_file, num_workers)
+		args = []
+		for i in range(num_workers):
+			args.append((input_file, offsets[i], offsets[i + 1],
+				f"{split_prefix}{i}_", split_size))
+		split_files = []
+		with multiprocessing.Pool(num_workers) as pool:
+			for range_split_files in pool.starmap(_count_range, args):
+				split_files.extend(range_split_files)
+
+	word_and_counts = _merge_counts(split_files)
+	if top_k is not None:
+		_write_top_k(word_and_counts, top_k, output_file)
+	elif order == "count":
+		_write_by_count(word_and_counts, split_prefix, output_file)
+	else:
+		assert order == "word"
+		with jsonlines.open(output_file, 'w') as fout:
+			for word, count in word_and_counts:
+				fout.write([word, count])
+
+	for split_file in split_files:
+		os.remove(split_file)
 
 if __name__ == "__main__":
-	assert len(sys.argv) == 5
+	assert len(sys.argv) in (5, 6, 7)
 	input_file = sys.argv[1]
 	split_prefix = sys.argv[2]
 	split_size = int(sys.argv[3])
 	output_file = sys.argv[4]
-	word_count(input_file, split_prefix, split_size, output_file)
\ No newline at end of file
+	num_workers = int(sys.argv[5]) if len(sys.argv) >= 6 else 1
+	order = sys.argv[6] if len(sys.argv) == 7 else "word"
+	top_k = None
+	if order not in ("word", "count"):
+		top_k = int(order)
+	word_count(input_file, split_prefix, split_size, output_file, num_workers,
+		order, top_k)
@@ -0,0 +1,100 @@
+r"""Tokenizer shared by the word count programs.
+
+# Problem
+
+Split text into tokens, where a token is either a run of word characters
+or a single character that is neither a word character nor whitespace,
+i.e., `re.findall(r"(\w+|[^\w\s])", text)`. Do it fast for large files.
+
+# Notes
+
+* Calling `re.findall` on every line allocates a list per line and pays
+  the call overhead per line. Instead, we read the file in large blocks
+  through a memory map and tokenize a whole block at a time with a
+  precompiled pattern. A block ends at the end of a line, so it never cuts
+  a token or a UTF-8 character in half.
+* ASCII fast path: if a block is ASCII (`bytes.isascii` is cheap), we
+  decode it as ASCII and match with `re.ASCII`, which is faster than the
+  Unicode pattern. For ASCII text, the only difference between the two
+  is that a str pattern's `\s` also matches the separator characters
+  `\x1c-\x1f` (`str.isspace` is True for them), so we exclude them
+  explicitly to keep exactly the same tokens.
+* `findall` is faster than `finditer` here, because `finditer` creates a
+  match object per token. The patterns have no capturing group: `findall`
+  returns the whole matches either way and skips the bookkeeping of the
+  group.
+* Most of the time is spent in the regex engine itself, which is the same
+  either way, so on ASCII text tokenizing a block at a time is only about
+  1.4-1.7x faster than a line at a time.
+* `intern=True` interns the tokens, so that repeated tokens share one
+  str. It makes tokenizing slower, but it saves memory when the tokens
+  are kept around and speeds up dict lookups with them.
+
+# Usage
+
+```python
+import word_tokenizer
+
+for block in word_tokenizer.read_blocks("84-0.txt"):
+	tokens = word_tokenizer.tokenize_block(block)
+```
+"""
+import mmap
+import os
+import re
+import sys
+
+BLOCK_SIZE = 1 << 24
+
+_PATTERN = re.compile(r"\w+|[^\w\s]")
+_ASCII_PATTERN = re.compile(r"\w+|[^\w\s\x1c-\x1f]", re.ASCII)
+
+def tokenize(text):
+	return _PATTERN.findall(text)
+
+def tokenize_block(block, intern=False):
+	"""Returns the tokens of a block of UTF-8 bytes."""
+	if block.isascii():
+		tokens = _ASCII_PATTERN.findall(block.decode("ascii"))
+	else:
+		tokens = _PATTERN.findall(block.decode("utf-8"))
+	if intern:
+		tokens = list(map(sys.intern, tokens))
+	return tokens
+
+def line_aligned_offsets(input_file, num_ranges):
+	"""Cuts a file into `num_ranges` byte ranges that start at the start of a line."""
+	size = os.path.getsize(input_file)
+	offsets = [0]
+	with open(input_file, 'rb') as fin:
+		for i in range(1, num_ranges):
+			# Skip to the start of the first line at or after the offset.
+			offset = max(offsets[-1], i * size // num_ranges)
+			# A file with fewer bytes than ranges has ranges at offset 0.
+			if offset == 0:
+				offsets.append(0)
+				continue
+			fin.seek(offset - 1)
+			fin.readline()
+			offsets.append(fin.tell())
+	offsets.append(size)
+	return offsets
+
+def read_blocks(input_file, start=0, end=None, block_size=BLOCK_SIZE):
+	"""Yields line-aligned blocks of the bytes in [start, end) of a file."""
+	if end is None:
+		end = os.path.getsize(input_file)
+	# An empty file can't be memory-mapped.
+	if start >= end:
+		return
+	with open(input_file, 'rb') as fin:
+		with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			offset = start
+			while offset < end:
+				block_end = min(offset + block_size, end)
+				if block_end < end:
+					# Finish the last line of the block.
+					newline = mm.find(b"\n", block_end - 1, end)
+					block_end = end if newline == -1 else newline + 1
+				yield mm[offset:block_end]
+				offset = block_end